@@ -0,0 +1,89 @@
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+from source.domain.entities.distance_matrix import DistanceMatrix
+from source.domain.matrix_cache_interface import MatrixCacheInterface
+
+
+class DiskMatrixCache(MatrixCacheInterface):
+    """Keeps distance matrices on the disk as .npy files, a directory per key, loaded memory-mapped.
+
+    The least recently used entries are removed when the total size exceeds max_bytes.
+    The modification time of an entry's directory is its last use, so the order survives restarts.
+    """
+
+    def __init__(self, directory, max_bytes: int = 1024 * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> DistanceMatrix | None:
+        path = self.path(key)
+        try:
+            distances = np.load(os.path.join(path, "distances.npy"), mmap_mode="r")
+            durations_path = os.path.join(path, "durations.npy")
+            durations = np.load(durations_path, mmap_mode="r") if os.path.exists(durations_path) else None
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            # Missing, evicted in the meantime or broken entry
+            return None
+        # DistanceMatrix keeps float32 contiguous arrays as they are, so the memory maps are not copied
+        return DistanceMatrix(distances=distances, durations=durations)
+
+    def put(self, key: str, matrix: DistanceMatrix):
+        # The entry is written to a temporary directory and renamed, so readers never see a partial one
+        temp_path = self.path(f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(temp_path)
+        np.save(os.path.join(temp_path, "distances.npy"), matrix.distances)
+        if matrix.durations is not None:
+            np.save(os.path.join(temp_path, "durations.npy"), matrix.durations)
+        with self.lock:
+            # An existing entry of the key (e.g. one stored without durations) is replaced
+            old_path = self.path(f".{key}.{uuid.uuid4().hex}.old")
+            try:
+                os.rename(self.path(key), old_path)
+            except FileNotFoundError:
+                pass
+            try:
+                os.rename(temp_path, self.path(key))
+            except OSError:
+                # Another process has cached the same matrix in the meantime
+                shutil.rmtree(temp_path, ignore_errors=True)
+            shutil.rmtree(old_path, ignore_errors=True)
+            self.evict()
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        """(last use, size, path) of every entry"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            for _, _, path in self.entries():
+                shutil.rmtree(path, ignore_errors=True)
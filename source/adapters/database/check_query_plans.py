@@ -0,0 +1,130 @@
+"""Runs every DatabaseSQLiteAdapter query on an empty in-memory database and checks its query plan.
+
+Fails when a query reads a large table with a full scan instead of an index search.
+Usage: python -m source.adapters.database.check_query_plans
+"""
+import datetime
+import re
+import sys
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from source.adapters.database.database_sqlite import DatabaseSQLiteAdapter
+
+# Tables growing with the number of orders and (quadratically) with the number of addresses
+LARGE_TABLES = {'addresses', 'orders', 'order_products', 'segments', 'segment_statistics'}
+
+TODAY = datetime.date(2024, 1, 1)
+IDS = [1, 2, 3]
+
+# Adapter calls covering every query, with the name used in the report.
+# Calls marked as full reads return whole tables on purpose and are not checked
+QUERIES = [
+    ('get_address', lambda db: db.get_address(1), False),
+    ('get_addresses', lambda db: db.get_addresses(), True),
+    ('get_addresses(ids)', lambda db: db.get_addresses(IDS), False),
+    ('get_depots', lambda db: db.get_depots(), False),
+    ('get_ungeocoded_addresses', lambda db: db.get_ungeocoded_addresses(), True),
+    ('get_client', lambda db: db.get_client(1), False),
+    ('get_clients', lambda db: db.get_clients(), True),
+    ('get_delivery_zone', lambda db: db.get_delivery_zone(1), False),
+    ('get_delivery_zones', lambda db: db.get_delivery_zones(), True),
+    ('get_delivery_zones(depot_id)', lambda db: db.get_delivery_zones(depot_id=1), False),
+    ('get_order', lambda db: db.get_order(1), False),
+    ('get_orders', lambda db: db.get_orders(), True),
+    ('get_orders(dates)', lambda db: db.get_orders(start_date=TODAY, end_date=TODAY), False),
+    ('get_orders(status)', lambda db: db.get_orders(status='delivered'), False),
+    ('get_orders(selected, dates)', lambda db: db.get_orders('selected', start_date=TODAY, end_date=TODAY), False),
+    ('get_orders(depot_id)', lambda db: db.get_orders(depot_id=1), False),
+    ('get_area_orders', lambda db: db.get_area_orders(1), False),
+    ('get_order_product', lambda db: db.get_order_product(1, 1), False),
+    ('get_order_products', lambda db: db.get_order_products(1), False),
+    ('get_product', lambda db: db.get_product(1), False),
+    ('get_products', lambda db: db.get_products(), True),
+    ('get_route', lambda db: db.get_route(1), False),
+    ('get_segment', lambda db: db.get_segment(1, 2), False),
+    ('get_segments', lambda db: db.get_segments(IDS), False),
+    ('get_unrouted_segments', lambda db: db.get_unrouted_segments(IDS), False),
+    ('get_unrouted_segments(all)', lambda db: db.get_unrouted_segments(), True),
+    ('get_segment_statistics', lambda db: db.get_segment_statistics(1), False),
+    ('get_segment_statistics_version', lambda db: db.get_segment_statistics_version(), False),
+    ('get_segments_statistics_matrices', lambda db: db.get_segments_statistics_matrices(IDS), False),
+    ('get_segments_statistics_matrices(mean)', lambda db: db.get_segments_statistics_matrices(IDS, 'mean'), False),
+    ('get_segment_statistics_records', lambda db: db.get_segment_statistics_records(IDS), False),
+    ('get_vehicle', lambda db: db.get_vehicle(1), False),
+    ('get_vehicles', lambda db: db.get_vehicles(), True),
+    ('get_vehicles(depot_id)', lambda db: db.get_vehicles(depot_id=1), False),
+]
+
+# "SCAN orders", "SCAN orders USING INDEX ..." and "SCAN orders USING COVERING INDEX ..." all read the whole table
+SCAN_PATTERN = re.compile(r'^SCAN (\w+)')
+
+
+@contextmanager
+def capture_statements(db: DatabaseSQLiteAdapter, statements: list):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def explain(db: DatabaseSQLiteAdapter, statement: str, parameters) -> list[str]:
+    with db.engine.connect() as connection:
+        rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan: list[str]) -> list[str]:
+    tables = []
+    for detail in plan:
+        match = SCAN_PATTERN.match(detail)
+        if match and match.group(1) in LARGE_TABLES:
+            tables.append(match.group(1))
+    return tables
+
+
+def check_query_plans(db: DatabaseSQLiteAdapter, verbose=False) -> list[tuple[str, str]]:
+    """Returns (query name, scanned table) for every full scan of a large table"""
+    failures = []
+    for name, call, full_read in QUERIES:
+        statements = []
+        with capture_statements(db, statements):
+            try:
+                call(db)
+            except AttributeError:
+                # Single row getters fail to build an entity from an empty result, the query has run already
+                pass
+
+        for statement, parameters in statements:
+            plan = explain(db, statement, parameters)
+            if verbose:
+                print(f'{name}:')
+                for detail in plan:
+                    print(f'    {detail}')
+            if not full_read:
+                failures += [(name, table) for table in full_scans(plan)]
+    return failures
+
+
+def main():
+    verbose = '-v' in sys.argv
+    # Shared in-memory database, every plain ':memory:' connection would get a separate empty one
+    db = DatabaseSQLiteAdapter('file:query_plans?mode=memory&cache=shared&uri=true')
+    db.create_tables()
+
+    failures = check_query_plans(db, verbose)
+    for name, table in failures:
+        print(f'FULL SCAN: {name} scans {table}')
+    if failures:
+        sys.exit(1)
+    print(f'OK: {len(QUERIES)} queries checked, no full scans of {", ".join(sorted(LARGE_TABLES))}')
+
+
+if __name__ == '__main__':
+    main()
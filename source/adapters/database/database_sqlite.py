@@ -1,14 +1,24 @@
 import datetime
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+
+import numpy as np
 
 from sqlalchemy import (
-    create_engine, MetaData, Table, Column, Integer, Text, Float, Date, Time, JSON, ForeignKey,
-    UniqueConstraint, or_, not_, select
+    create_engine, event, inspect, MetaData, Table, Column, Integer, Text, Float, Date, Time, JSON, ForeignKey,
+    UniqueConstraint, Index, or_, select, func, exists
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
 
 from source.domain.database_interface import DatabaseInterface
 
 from source.domain.entities.address import Address
+from source.domain.entities.area_orders import AreaOrders
 from source.domain.entities.client import Client
+from source.domain.entities.compiled_problem import to_hours
 from source.domain.entities.delivery_zone import DeliveryZone
 from source.domain.entities.order import Order
 from source.domain.entities.order_product import OrderProduct
@@ -21,6 +31,46 @@ from source.domain.entities.vehicle import Vehicle
 
 metadata = MetaData()
 
+# Both address id lists of a query are bound as parameters, two chunks stay under the default SQLite limit of 999
+SQLITE_CHUNK_SIZE = 450
+SEGMENT_STATISTICS_AGGREGATES = ('latest', 'mean', 'min')
+
+
+@dataclass(frozen=True)
+class SQLiteProfile:
+    """Pragmas applied to every new connection, None leaves the SQLite default"""
+    # WAL lets readers work while a writer is active and makes commits much cheaper
+    journal_mode: str | None = 'WAL'
+    # NORMAL is durable in WAL mode except for the last transactions on a power loss
+    synchronous: str | None = 'NORMAL'
+    mmap_size: int | None = 256 * 1024 * 1024  # bytes
+    cache_size: int | None = -64 * 1024  # negative values are in KiB
+    temp_store: str | None = 'MEMORY'
+    busy_timeout: int | None = 5000  # ms
+
+    @classmethod
+    def from_config(cls, value):
+        """Accepts a profile, a name of a predefined profile or a dict of pragmas"""
+        if value is None:
+            return SQLITE_PROFILES['default']
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            return SQLITE_PROFILES[value]
+        return cls(**value)
+
+    def pragmas(self) -> list[str]:
+        return [
+            f'PRAGMA {field.name} = {getattr(self, field.name)}'
+            for field in fields(self) if getattr(self, field.name) is not None
+        ]
+
+
+SQLITE_PROFILES = {
+    'default': SQLiteProfile(None, None, None, None, None, None),
+    'production': SQLiteProfile()
+}
+
 
 addresses = Table(
     'addresses',
@@ -31,7 +81,8 @@ addresses = Table(
     Column('string_address', Text, unique=True),
     Column('machine_address', Text, unique=True),
     Column('delivery_zone_id', Integer, ForeignKey("delivery_zones.id")),
-    UniqueConstraint('latitude', 'longitude', name='_address_coords_uc')
+    UniqueConstraint('latitude', 'longitude', name='_address_coords_uc'),
+    Index('ix_addresses_delivery_zone_id', 'delivery_zone_id')
 )
 
 segments = Table(
@@ -54,7 +105,9 @@ segment_statistics = Table(
     Column('date', Date),
     Column('start_time', Time),
     Column('week_day', Integer),
-    Column('json_response', JSON)
+    Column('json_response', JSON),
+    # Statistics of a segment are read in the order they were recorded, the latest one is the last
+    Index('ix_segment_statistics_segment_id', 'segment_id', 'record_id')
 )
 
 delivery_zones = Table(
@@ -63,7 +116,8 @@ delivery_zones = Table(
     Column('id', Integer, primary_key=True),
     Column('name', Text, unique=True),
     Column('type', Integer),
-    Column('depot_id', Integer, ForeignKey("addresses.id"))
+    Column('depot_id', Integer, ForeignKey("addresses.id")),
+    Index('ix_delivery_zones_depot_id', 'depot_id')
 )
 
 orders = Table(
@@ -77,7 +131,10 @@ orders = Table(
     Column('delivery_time_start', Time),
     Column('delivery_time_end', Time),
     Column('comment', Text),
-    Column('status', Integer)
+    Column('status', Integer),
+    Index('ix_orders_date', 'date'),
+    Index('ix_orders_status_date', 'status', 'date'),
+    Index('ix_orders_address_id', 'address_id')
 )
 
 clients = Table(
@@ -106,7 +163,10 @@ vehicles = Table(
     Column('name', Text, unique=True),
     Column('category', Text),
     Column('dimensions', JSON),
-    Column('weight_capacity', Integer)
+    Column('volume_capacity', Float),
+    Column('weight_capacity', Integer),
+    Column('depot_id', Integer, ForeignKey("addresses.id")),
+    Index('ix_vehicles_depot_id', 'depot_id')
 )
 
 products = Table(
@@ -116,7 +176,7 @@ products = Table(
     Column('name', Text, unique=True),
     Column('form_factor', Integer),
     Column('dimensions', JSON),
-    Column('weight', Integer)
+    Column('volume', Float)
 )
 
 order_products = Table(
@@ -132,14 +192,179 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
     # ***************************
     # General methods
     # ***************************
-    def __init__(self, db_path):
+    def __init__(
+            self,
+            db_path,
+            profile: SQLiteProfile | str | dict | None = 'production',
+            pool_size=5,
+            max_overflow=10
+    ):
 
         self.metadata = metadata
-        engine = create_engine(f"sqlite+pysqlite:///{db_path}")
-        self.__connection = engine.connect()
+        self.profile = SQLiteProfile.from_config(profile)
+        if db_path == ':memory:':
+            # Every connection to ':memory:' is a separate database, SQLAlchemy keeps one per thread
+            self.engine = create_engine("sqlite+pysqlite:///:memory:")
+        else:
+            # Connections are taken from the pool by the threads and returned to it by release_connection()
+            self.engine = create_engine(
+                f"sqlite+pysqlite:///{db_path}",
+                poolclass=QueuePool,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                connect_args={"check_same_thread": False}
+            )
+        event.listen(self.engine, 'connect', self.apply_profile)
+        # Connection, its mode and the depth of the nested transaction() blocks of the current thread
+        self.__local = threading.local()
+
+    @property
+    def __connection(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = self.engine.connect()
+            if self.read_only:
+                connection.exec_driver_sql("PRAGMA query_only = ON")
+            self.__local.connection = connection
+        return connection
+
+    @property
+    def read_only(self) -> bool:
+        return getattr(self.__local, 'read_only', False)
+
+    def set_read_only(self, read_only: bool):
+        """Makes the connections of the current thread reject writes, e.g. while serving a GET request"""
+        connection = getattr(self.__local, 'connection', None)
+        if connection is not None and read_only != self.read_only:
+            connection.exec_driver_sql(f"PRAGMA query_only = {'ON' if read_only else 'OFF'}")
+        self.__local.read_only = read_only
+
+    def release_connection(self):
+        """Returns the connection of the current thread to the pool, an unfinished transaction is rolled back"""
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            return
+        if self.read_only:
+            # The pooled connection may serve a writer next time
+            connection.exec_driver_sql("PRAGMA query_only = OFF")
+        connection.close()
+        self.__local.connection = None
+        self.__local.read_only = False
+        self.__local.transaction_depth = 0
+
+    @property
+    def __transaction_depth(self) -> int:
+        # Writes are not committed one by one inside transaction() blocks
+        return getattr(self.__local, 'transaction_depth', 0)
+
+    @__transaction_depth.setter
+    def __transaction_depth(self, depth: int):
+        self.__local.transaction_depth = depth
+
+    def apply_profile(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in self.profile.pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        """Groups the writes inside the block into a single commit.
+        Nested blocks are savepoints, an exception rolls back the innermost block only"""
+        connection = self.__connection
+        if self.__transaction_depth > 0:
+            self.__transaction_depth += 1
+            try:
+                with connection.begin_nested():
+                    yield self
+            finally:
+                self.__transaction_depth -= 1
+            return
+
+        # Ends the transaction left open by previous reads
+        if connection.in_transaction():
+            connection.commit()
+        # pysqlite begins a transaction only before DML, so the first savepoint would start
+        # the transaction by itself and commit it on release
+        connection.exec_driver_sql("BEGIN")
+        self.__transaction_depth = 1
+        try:
+            yield self
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+        finally:
+            self.__transaction_depth = 0
+
+    def _commit(self):
+        if self.__transaction_depth == 0:
+            self.__connection.commit()
     
     def create_tables(self):
         self.metadata.create_all(self.__connection)
+        self.upgrade_schema()
+        self._commit()
+
+    def upgrade_schema(self):
+        """Brings the tables of a database created by an older version up to the current schema.
+
+        create_all skips the existing tables, so their missing columns are added by ALTER TABLE ... ADD COLUMN
+        (products.volume, vehicles.volume_capacity and vehicles.depot_id, which are NULL in the old rows)
+        and their missing indexes are created. Dropped columns, like products.weight, are left in place unused.
+        """
+        connection = self.__connection
+        inspector = inspect(connection)
+        for table in self.metadata.tables.values():
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+    def upsert(self, table: Table, values: dict):
+        """Inserts the row or updates the existing one with the same primary key"""
+        query = sqlite_insert(table).values(**values)
+        query = query.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={name: query.excluded[name] for name in values if not table.c[name].primary_key}
+        )
+        self.__connection.execute(query)
+        self._commit()
+
+    def upsert_many(self, table: Table, rows: list[dict], batch_size: int = 500) -> tuple[int, int]:
+        """Upserts the rows with one executemany per batch and a single commit.
+        Returns the numbers of inserted and updated rows"""
+        if not rows:
+            return 0, 0
+        key = [column.name for column in table.primary_key]
+        # The last version of a row wins, as with the single row upserts one after another
+        rows = list({tuple(row[name] for name in key): row for row in rows}.values())
+
+        query = sqlite_insert(table)
+        query = query.on_conflict_do_update(
+            index_elements=key,
+            set_={name: query.excluded[name] for name in rows[0] if not table.c[name].primary_key}
+        )
+
+        updated = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            if len(key) == 1:
+                # Existing rows are counted before the write, to tell the updates from the inserts
+                ids = [row[key[0]] for row in batch]
+                for chunk in range(0, len(ids), SQLITE_CHUNK_SIZE):
+                    updated += self.__connection.execute(
+                        select(func.count()).select_from(table).where(
+                            table.c[key[0]].in_(ids[chunk:chunk + SQLITE_CHUNK_SIZE])
+                        )
+                    ).scalar()
+            self.__connection.execute(query, batch)
+        self._commit()
+        return len(rows) - updated, updated
 
     # ***************************
     # Address
@@ -153,19 +378,44 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             delivery_zone_id=address.delivery_zone_id
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
 
     def get_address(self, address_id: int):
         query = addresses.select().where(addresses.c.id == address_id)
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return Address(**row)
+        return Address(**row._mapping)
+
+    def upsert_address(self, address: Address):
+        self.upsert(addresses, vars(address))
+
+    def upsert_addresses(self, addresses_list: list[Address], batch_size: int = 500) -> tuple[int, int]:
+        return self.upsert_many(addresses, [vars(address) for address in addresses_list], batch_size)
+
+    def get_addresses(self, addresses_ids: list[int] | None = None) -> list[Address]:
+        """Returns all the addresses or the ones with the given ids, queried in chunks of ids"""
+        if addresses_ids is None:
+            cursor = self.__connection.execute(addresses.select())
+            return [Address(**row._mapping) for row in cursor.fetchall()]
+
+        ids = list(addresses_ids)
+        rows = []
+        for start in range(0, len(ids), SQLITE_CHUNK_SIZE):
+            query = addresses.select().where(addresses.c.id.in_(ids[start:start + SQLITE_CHUNK_SIZE]))
+            rows += self.__connection.execute(query).fetchall()
+        return [Address(**row._mapping) for row in rows]
 
     def get_depots(self):
-        query = addresses.select().where(addresses.c.delivery_zone_id is None)
+        query = addresses.select().where(addresses.c.delivery_zone_id.is_(None))
+        cursor = self.__connection.execute(query)
+        rows = cursor.fetchall()
+        return [Address(**row._mapping) for row in rows]
+
+    def get_ungeocoded_addresses(self) -> list[Address]:
+        query = addresses.select().where(or_(addresses.c.latitude.is_(None), addresses.c.longitude.is_(None)))
         cursor = self.__connection.execute(query)
         rows = cursor.fetchall()
-        return [Address(**row) for row in rows]
+        return [Address(**row._mapping) for row in rows]
 
     # ***************************
     # Client
@@ -175,19 +425,19 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             name=client.name
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
 
     def get_client(self, client_id: int):
         query = clients.select().where(clients.c.id == client_id)
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return Client(**row)
+        return Client(**row._mapping)
 
     def get_clients(self) -> list[Client]:
         query = clients.select()
         cursor = self.__connection.execute(query)
         rows = cursor.fetchall()
-        return [Client(**row) for row in rows]
+        return [Client(**row._mapping) for row in rows]
 
     # ***************************
     # Delivery Zone
@@ -199,13 +449,16 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             depot_id=delivery_zone.depot_id
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
+
+    def upsert_delivery_zone(self, delivery_zone: DeliveryZone):
+        self.upsert(delivery_zones, vars(delivery_zone))
 
     def get_delivery_zone(self, delivery_zone_id: int):
         query = delivery_zones.select().where(delivery_zones.c.id == delivery_zone_id)
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return DeliveryZone(**row)
+        return DeliveryZone(**row._mapping)
 
     def get_delivery_zones(self, depot_id=-1) -> list[DeliveryZone]:
         if depot_id != -1:
@@ -214,7 +467,7 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             query = delivery_zones.select()
         cursor = self.__connection.execute(query)
         rows = cursor.fetchall()
-        return [DeliveryZone(**row) for row in rows]
+        return [DeliveryZone(**row._mapping) for row in rows]
 
     # ***************************
     # Order
@@ -231,13 +484,19 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             status=order.status
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
+
+    def upsert_order(self, order: Order):
+        self.upsert(orders, vars(order))
+
+    def upsert_orders(self, orders_list: list[Order], batch_size: int = 500) -> tuple[int, int]:
+        return self.upsert_many(orders, [vars(order) for order in orders_list], batch_size)
 
     def get_order(self, order_id: int):
         query = orders.select().where(orders.c.id == order_id)
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return Order(**row)
+        return Order(**row._mapping)
 
     def get_orders(self, status=None, depot_id=-1, start_date=None, end_date=None):
         if end_date is None:
@@ -256,11 +515,11 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
 
         if depot_id != -1:
             query = query.where(
-                orders.c.address_id == select(addresses.c.id).where(
-                    addresses.c.delivery_zone_id == select(delivery_zones.c.id).where(
+                orders.c.address_id.in_(select(addresses.c.id).where(
+                    addresses.c.delivery_zone_id.in_(select(delivery_zones.c.id).where(
                         delivery_zones.c.depot_id == depot_id
-                    )
-                )
+                    ))
+                ))
             )
 
         query = query.where(
@@ -270,7 +529,57 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
 
         cursor = self.__connection.execute(query)
         rows = cursor.fetchall()
-        return [Order(**row) for row in rows]
+        return [Order(**row._mapping) for row in rows]
+
+    def get_area_orders(self, depot_id: int, status: int | None = 0) -> AreaOrders:
+        """Orders of the depot area with the coordinates and zones of their addresses
+        and the total volume of their products in a single query"""
+        # Correlated per order, so only the products of the selected orders are read
+        volume = select(
+            func.coalesce(func.sum(products.c.volume * order_products.c.quantity), 0.)
+        ).join(
+            products, products.c.id == order_products.c.product_id
+        ).where(
+            order_products.c.order_id == orders.c.id
+        ).scalar_subquery()
+
+        query = select(
+            orders.c.id,
+            orders.c.address_id,
+            addresses.c.delivery_zone_id,
+            addresses.c.latitude,
+            addresses.c.longitude,
+            volume,
+            orders.c.delivery_time_start,
+            orders.c.delivery_time_end
+        ).join(
+            addresses, addresses.c.id == orders.c.address_id
+        ).join(
+            delivery_zones, delivery_zones.c.id == addresses.c.delivery_zone_id
+        ).where(
+            delivery_zones.c.depot_id == depot_id
+        ).order_by(orders.c.id)
+        if status is not None:
+            query = query.where(orders.c.status == status)
+
+        rows = self.__connection.execute(query).fetchall()
+        columns = list(zip(*rows)) if rows else [()] * 8
+
+        def hours(times):
+            return [np.nan if t is None else to_hours(t) for t in times]
+
+        return AreaOrders(
+            order_ids=np.array(columns[0], dtype=np.int64),
+            address_ids=np.array(columns[1], dtype=np.int64),
+            delivery_zone_ids=np.array(columns[2], dtype=np.int64),
+            locations=np.array(
+                [columns[3], columns[4]], dtype=np.float64
+            ).T.reshape(len(rows), 2),
+            volumes=np.array(columns[5], dtype=np.float64),
+            time_windows=np.array(
+                [hours(columns[6]), hours(columns[7])], dtype=np.float64
+            ).T.reshape(len(rows), 2)
+        )
 
     def insert_order_product(self, order_product: OrderProduct):
         query = order_products.insert().values(
@@ -279,7 +588,7 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             quantity=order_product.quantity
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
 
     def get_order_product(self, order_id: int, product_id: int):
         query = order_products.select().where(
@@ -288,7 +597,13 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
         )
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return OrderProduct(**row)
+        return OrderProduct(**row._mapping)
+
+    def get_order_products(self, order_id: int) -> list[OrderProduct]:
+        query = order_products.select().where(order_products.c.order_id == order_id)
+        cursor = self.__connection.execute(query)
+        rows = cursor.fetchall()
+        return [OrderProduct(**row._mapping) for row in rows]
 
     # ***************************
     # Product
@@ -301,13 +616,25 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             volume=product.volume
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
+
+    def upsert_product(self, product: Product):
+        self.upsert(products, vars(product))
+
+    def upsert_products(self, products_list: list[Product], batch_size: int = 500) -> tuple[int, int]:
+        return self.upsert_many(products, [vars(product) for product in products_list], batch_size)
 
     def get_product(self, product_id: int):
         query = products.select().where(products.c.id == product_id)
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return Product(**row)
+        return Product(**row._mapping)
+
+    def get_products(self) -> list[Product]:
+        query = products.select()
+        cursor = self.__connection.execute(query)
+        rows = cursor.fetchall()
+        return [Product(**row._mapping) for row in rows]
 
     # ***************************
     # Route
@@ -322,13 +649,13 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             duration=route.duration
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
 
     def get_route(self, route_id: int):
         query = routes.select().where(routes.c.id == route_id)
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return Route(**row)
+        return Route(**row._mapping)
 
     # ***************************
     # Segment
@@ -340,7 +667,30 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             direct_distance=segment.direct_distance
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
+
+    def insert_segments(self, segments_list: list[Segment], batch_size: int = 500) -> int:
+        """Inserts the missing segments with one executemany per batch and a single commit.
+        Existing segments only get the direct distance if they had none.
+        Returns the number of inserted and filled segments"""
+        query = sqlite_insert(segments)
+        query = query.on_conflict_do_update(
+            index_elements=['address_1_id', 'address_2_id'],
+            set_={'direct_distance': query.excluded.direct_distance},
+            where=segments.c.direct_distance.is_(None)
+        )
+        rows = [
+            {
+                'address_1_id': segment.address_1_id,
+                'address_2_id': segment.address_2_id,
+                'direct_distance': segment.direct_distance
+            } for segment in segments_list
+        ]
+        changed = 0
+        for start in range(0, len(rows), batch_size):
+            changed += self.__connection.execute(query, rows[start:start + batch_size]).rowcount
+        self._commit()
+        return changed
 
     def get_segment(self, address_1_id: int, address_2_id: int):
         query = segments.select().where(
@@ -349,28 +699,32 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
         )
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return Segment(**row)
+        return Segment(**row._mapping)
 
-    def get_segments(self, addresses_ids: list[int]) -> list[Segment]:
-        query = segments.select().where(
-            orders.c.address_1_id.in_(addresses_ids),
-            orders.c.address_2_id.in_(addresses_ids)
-        )
+    def get_segments(self, addresses_ids: list[int] | None = None) -> list[Segment]:
+        """Returns the segments between the given addresses, or all the segments if no ids are given"""
+        query = segments.select()
+        if addresses_ids is not None:
+            query = query.where(
+                segments.c.address_1_id.in_(addresses_ids),
+                segments.c.address_2_id.in_(addresses_ids)
+            )
         cursor = self.__connection.execute(query)
         rows = cursor.fetchall()
-        return [Segment(**row) for row in rows]
+        return [Segment(**row._mapping) for row in rows]
 
-    def get_unrouted_segments(self, addresses_ids: list[int]) -> list[Segment]:
-        query = segments.select().where(
-            segments.c.address_1_id.in_(addresses_ids),
-            segments.c.address_2_id.in_(addresses_ids),
-            not_(segments.c.id.in_(
-                select([segment_statistics.c.segment_id])
-            ))
-        )
+    def get_unrouted_segments(self, addresses_ids: list[int] | None = None) -> list[Segment]:
+        """Returns the segments without statistics between the given addresses, or among all the segments"""
+        # Checked per segment with the segment_id index instead of collecting all the routed segments
+        query = segments.select().where(~exists().where(segment_statistics.c.segment_id == segments.c.id))
+        if addresses_ids is not None:
+            query = query.where(
+                segments.c.address_1_id.in_(addresses_ids),
+                segments.c.address_2_id.in_(addresses_ids)
+            )
         cursor = self.__connection.execute(query)
         rows = cursor.fetchall()
-        return [Segment(**row) for row in rows]
+        return [Segment(**row._mapping) for row in rows]
 
     def insert_segment_statistics(self, segment_statistic: SegmentStatistics):
         query = segment_statistics.insert().values(
@@ -383,13 +737,132 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             json_response=segment_statistic.json_response
         )
         self.__connection.execute(query)
-        self.__connection.commit()
-
-    def get_segment_statistics(self, segment_id: int):
-        query = segment_statistics.select().where(segment_statistics.c.segment_id == segment_id)
+        self._commit()
+
+    def insert_segments_statistics(self, statistics: list[SegmentStatistics], batch_size: int = 500) -> int:
+        """Inserts the statistics with one executemany per batch and a single commit.
+        Returns the number of inserted rows"""
+        rows = [
+            {
+                "segment_id": statistic.segment_id,
+                "distance": statistic.distance,
+                "duration": statistic.duration,
+                "date": statistic.date,
+                "start_time": statistic.start_time,
+                "week_day": statistic.week_day,
+                "json_response": statistic.json_response
+            } for statistic in statistics
+        ]
+        for start in range(0, len(rows), batch_size):
+            self.__connection.execute(segment_statistics.insert(), rows[start:start + batch_size])
+        self._commit()
+        return len(rows)
+
+    def get_segment_statistics(self, segment_id: int) -> list[SegmentStatistics]:
+        query = segment_statistics.select().where(
+            segment_statistics.c.segment_id == segment_id
+        ).order_by(segment_statistics.c.record_id)
         cursor = self.__connection.execute(query)
-        row = cursor.fetchone()
-        return SegmentStatistics(**row)
+        rows = cursor.fetchall()
+        return [SegmentStatistics(**row._mapping) for row in rows]
+
+    def get_segment_statistics_version(self) -> int:
+        """Id of the latest statistics record, statistics are only appended, so any new data changes it"""
+        query = select(func.max(segment_statistics.c.record_id))
+        return self.__connection.execute(query).scalar() or 0
+
+    def get_segments_statistics_matrices(self, addresses_ids: list[int], aggregate: str = 'latest'):
+        """Loads distances and durations between all the given addresses with a JOINed query per chunk of ids.
+        Pairs without statistics are left as NaN. Several records of a segment are reduced with the aggregate:
+        'latest' record, 'mean' or 'min' of the records"""
+        if aggregate not in SEGMENT_STATISTICS_AGGREGATES:
+            raise ValueError(f"Unknown segment statistics aggregate: {aggregate}")
+
+        ids = np.asarray(addresses_ids, dtype=np.int64)
+        size = len(ids)
+        distances = np.full((size, size), np.nan, dtype=np.float32)
+        durations = np.full((size, size), np.nan, dtype=np.float32)
+        np.fill_diagonal(distances, 0.)
+        np.fill_diagonal(durations, 0.)
+        if size == 0:
+            return distances, durations
+
+        # Positions of the ids are found by binary search over the sorted ids
+        order = np.argsort(ids, kind='stable')
+        sorted_ids = ids[order]
+
+        chunks = [sorted_ids[start:start + SQLITE_CHUNK_SIZE].tolist() for start in range(0, size, SQLITE_CHUNK_SIZE)]
+        for chunk_1 in chunks:
+            for chunk_2 in chunks:
+                query = self.segments_statistics_query(chunk_1, chunk_2, aggregate)
+                rows = self.__connection.execute(query).fetchall()
+                if not rows:
+                    continue
+                values = np.array(rows, dtype=np.float64)
+                i = order[np.searchsorted(sorted_ids, values[:, 0].astype(np.int64))]
+                j = order[np.searchsorted(sorted_ids, values[:, 1].astype(np.int64))]
+                distances[i, j] = values[:, 2]
+                durations[i, j] = values[:, 3]
+        return distances, durations
+
+    def get_segment_statistics_records(self, addresses_ids: list[int]) -> dict[str, np.ndarray]:
+        """Loads every statistics record of the segments between the given addresses in columns:
+        address_1_id, address_2_id, week_day, start_time (hours), distance and duration,
+        with a JOINed query per chunk of ids"""
+        ids = sorted(set(addresses_ids))
+        chunks = [ids[start:start + SQLITE_CHUNK_SIZE] for start in range(0, len(ids), SQLITE_CHUNK_SIZE)]
+        rows = []
+        for chunk_1 in chunks:
+            for chunk_2 in chunks:
+                query = select(
+                    segments.c.address_1_id,
+                    segments.c.address_2_id,
+                    segment_statistics.c.week_day,
+                    segment_statistics.c.start_time,
+                    segment_statistics.c.distance,
+                    segment_statistics.c.duration
+                ).join(
+                    segment_statistics, segment_statistics.c.segment_id == segments.c.id
+                ).where(
+                    segments.c.address_1_id.in_(chunk_1),
+                    segments.c.address_2_id.in_(chunk_2)
+                )
+                rows += self.__connection.execute(query).fetchall()
+
+        columns = list(zip(*rows)) if rows else [()] * 6
+        return {
+            'address_1_id': np.array(columns[0], dtype=np.int64),
+            'address_2_id': np.array(columns[1], dtype=np.int64),
+            'week_day': np.array([-1 if d is None else d for d in columns[2]], dtype=np.int64),
+            'start_time': np.array(
+                [np.nan if t is None else to_hours(t) for t in columns[3]],
+                dtype=np.float64
+            ),
+            'distance': np.array(columns[4], dtype=np.float64),
+            'duration': np.array(columns[5], dtype=np.float64)
+        }
+
+    @staticmethod
+    def segments_statistics_query(addresses_1_ids: list[int], addresses_2_ids: list[int], aggregate: str):
+        columns = [segments.c.address_1_id, segments.c.address_2_id]
+        if aggregate == 'latest':
+            # SQLite takes the bare columns from the row holding the max() value, that is the latest record
+            columns += [
+                segment_statistics.c.distance,
+                segment_statistics.c.duration,
+                func.max(segment_statistics.c.record_id)
+            ]
+        elif aggregate == 'mean':
+            columns += [func.avg(segment_statistics.c.distance), func.avg(segment_statistics.c.duration)]
+        else:
+            columns += [func.min(segment_statistics.c.distance), func.min(segment_statistics.c.duration)]
+
+        return select(*columns).join(
+            segment_statistics, segment_statistics.c.segment_id == segments.c.id
+        ).where(
+            segments.c.address_1_id.in_(addresses_1_ids),
+            segments.c.address_2_id.in_(addresses_2_ids)
+        ).group_by(segments.c.id)
 
     # ***************************
     # Vehicle
@@ -399,16 +872,24 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             name=vehicle.name,
             category=vehicle.category,
             dimensions=vehicle.dimensions,
-            weight_capacity=vehicle.weight_capacity
+            volume_capacity=vehicle.volume_capacity,
+            weight_capacity=vehicle.weight_capacity,
+            depot_id=vehicle.depot_id
         )
         self.__connection.execute(query)
-        self.__connection.commit()
+        self._commit()
+
+    def upsert_vehicle(self, vehicle: Vehicle):
+        self.upsert(vehicles, vars(vehicle))
+
+    def upsert_vehicles(self, vehicles_list: list[Vehicle], batch_size: int = 500) -> tuple[int, int]:
+        return self.upsert_many(vehicles, [vars(vehicle) for vehicle in vehicles_list], batch_size)
 
     def get_vehicle(self, vehicle_id: int):
         query = vehicles.select().where(vehicles.c.id == vehicle_id)
         cursor = self.__connection.execute(query)
         row = cursor.fetchone()
-        return Vehicle(**row)
+        return Vehicle(**row._mapping)
 
     def get_vehicles(self, depot_id=-1) -> list[Vehicle]:
         if depot_id != -1:
@@ -417,4 +898,4 @@ class DatabaseSQLiteAdapter(DatabaseInterface):
             query = vehicles.select()
         cursor = self.__connection.execute(query)
         rows = cursor.fetchall()
-        return [Vehicle(**row) for row in rows]
+        return [Vehicle(**row._mapping) for row in rows]
@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+
+from source.domain.data_routing_interface import RoutingDataInterface
+
+
+class TokenBucket:
+    """Allows rate requests per second on average and bursts of up to capacity requests"""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        if rate <= 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        if capacity < 1:
+            raise ValueError(f"Token bucket capacity must be at least 1, got {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            # Sleeping outside the lock lets the other threads refill and take tokens in the meantime
+            time.sleep(wait)
+
+
+class RateLimitedRouting(RoutingDataInterface):
+    """Wraps a routing data source to be called from several threads at once.
+
+    Requests are limited by a token bucket and by the number of requests in flight,
+    failed requests are retried with exponential backoff and jitter.
+    DataOperator runs max_in_flight tile requests concurrently with this wrapper.
+    """
+
+    def __init__(
+            self,
+            routing_data: RoutingDataInterface,
+            requests_per_second: float = 1.,
+            burst: int = 1,
+            max_in_flight: int = 4,
+            max_retries: int = 3,
+            backoff: float = 1.,  # Delay before the first retry, seconds, doubled for each next one
+            max_backoff: float = 30.,
+            retry_on: tuple = (Exception,)
+    ):
+        self.routing_data = routing_data
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+
+    @property
+    def max_matrix_size(self):
+        return self.routing_data.max_matrix_size
+
+    def call(self, func, *args):
+        for attempt in range(self.max_retries + 1):
+            try:
+                # The slot is taken first, so waiting for it doesn't use up the rate budget
+                with self.in_flight:
+                    self.bucket.acquire()
+                    return func(*args)
+            except self.retry_on:
+                if attempt == self.max_retries:
+                    raise
+            # Full jitter keeps the threads failed at the same moment from retrying in lockstep
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def get_segment_data(self, source: tuple[float, float], destination: tuple[float, float], segment_id) -> dict:
+        return self.call(self.routing_data.get_segment_data, source, destination, segment_id)
+
+    def get_matrix_data(
+            self, sources: list[tuple[float, float]], destinations: list[tuple[float, float]]
+    ) -> tuple[list[list[float | None]], list[list[float | None]]]:
+        return self.call(self.routing_data.get_matrix_data, sources, destinations)
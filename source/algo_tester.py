@@ -1,12 +1,21 @@
-"""Script for testing solvers and gathering statistics"""
+"""Script for testing solvers and gathering statistics
+
+Benchmark usage: python -m source.algo_tester --sizes 10 100 1000 --baseline baseline.json [--update-baseline]
+"""
+import argparse
+import json
 import random
-import numpy as np
-from scipy.spatial import distance_matrix as dm
+import sys
+import tracemalloc
 from source.solvers.greedy_solver import GreedySolver
 from source.solvers.ant_colony_solver import AntColonySolver
-from time import time
+from source.solvers.distance_evaluators import create_euclidian_distance_matrix
+from time import time, perf_counter, process_time
 import pandas as pd
 from source.adapters.loggers.logger import Logger
+from source.domain.entities.problem import Problem
+from source.domain.entities.compiled_problem import CompiledProblem, read_snapshot_meta, SNAPSHOT_META_FILE
+import os
 
 
 def generate_test_case(
@@ -17,7 +26,8 @@ def generate_test_case(
         max_demand=10,
         max_volume=2,  # cubic meters
         vehicle_capacity=30,
-        time_window_span=12  # Length of the time period, in which delivery is possible
+        time_window_span=12,  # Length of the time period, in which delivery is possible
+        num_clusters=None  # Locations are grouped around this number of centers, uniform if None
 ):
     """
     Generate test data for the VRP problem.
@@ -31,12 +41,23 @@ def generate_test_case(
         max_volume: Maximum volume per item
         vehicle_capacity: Capacity of each vehicle
         time_window_span: Time window span in hours
+        num_clusters: Number of location clusters, None for uniformly spread locations
     """
     # Generate random locations
     locations = [[depot_location[0], depot_location[1]]]  # Start with depot
+    if num_clusters:
+        centers = [
+            (random.uniform(-area_size / 2, area_size / 2), random.uniform(-area_size / 2, area_size / 2))
+            for _ in range(num_clusters)
+        ]
     for _ in range(num_locations):
-        x = random.uniform(-area_size / 2, area_size / 2)
-        y = random.uniform(-area_size / 2, area_size / 2)
+        if num_clusters:
+            center = random.choice(centers)
+            x = random.gauss(center[0], area_size / 40)
+            y = random.gauss(center[1], area_size / 40)
+        else:
+            x = random.uniform(-area_size / 2, area_size / 2)
+            y = random.uniform(-area_size / 2, area_size / 2)
         locations.append([x, y])
 
     # Generate demands (depot has no demand)
@@ -59,13 +80,10 @@ def generate_test_case(
             end = min(start + time_window_span, 24)
             time_windows.append((start, end))
 
-    # distance_matrix = dm(locations, locations)
     vehicle_capacities = [vehicle_capacity] * num_vehicles
 
-    def distance_evaluator(from_index, to_index):
-        dist = np.linalg.norm(np.array(locations[from_index]) - np.array(locations[to_index]))
-        return dist
-        # return distance_matrix[from_index][to_index]
+    # All the pairwise distances are computed at once, solvers index the matrix directly
+    distance_evaluator = create_euclidian_distance_matrix(locations)
 
     problem_data = {
         'locations': locations,
@@ -79,23 +97,56 @@ def generate_test_case(
     return problem_data
 
 
+def load_snapshot_case(snapshot_dir, mmap=True):
+    """
+    Load a problem snapshot saved from a real planning day (see DeliveryPlanner.build_routes).
+
+    Args:
+        snapshot_dir: Directory of the snapshot
+        mmap: Memory-map the arrays instead of reading them into memory
+
+    Returns:
+        The compiled problem, accepted by test_solver as a test case
+    """
+    return CompiledProblem.load_snapshot(snapshot_dir, mmap=mmap)
+
+
+def find_snapshots(root_dir):
+    """
+    Find all the problem snapshots under the directory.
+
+    Args:
+        root_dir: Directory to search in
+
+    Returns:
+        List of (snapshot directory, snapshot meta) tuples
+    """
+    snapshots = []
+    for directory, _, files in sorted(os.walk(root_dir)):
+        if SNAPSHOT_META_FILE in files:
+            snapshots.append((directory, read_snapshot_meta(directory)))
+    return snapshots
+
+
 def test_solver(solver, test_case):
     """
     Test a solver on a given test case.
 
     Args:
         solver: The solver to be tested
-        test_case: The test case data
+        test_case: The test case data, generated or a compiled problem loaded from a snapshot
 
     Returns:
         The solution obtained by the solver
     """
-    # Add logger to the kwargs
-    test_case["logger"] = Logger()
-
     # Solve the VRP problem using the provided solver
     s = time()
-    routes = solver(**test_case).solve()
+    if isinstance(test_case, CompiledProblem):
+        routes = solver.from_compiled(test_case, logger=Logger()).solve()
+    else:
+        # Add logger to the kwargs
+        test_case["logger"] = Logger()
+        routes = solver(**test_case).solve()
     e = time()
     results = [
         {
@@ -107,33 +158,242 @@ def test_solver(solver, test_case):
     return results
 
 
-def main():
-    df = pd.DataFrame(columns=['num_locations', 'solver', 'total_time', 'total_volume', 'compute_time'])
-    for num_locations in [10, 100, 1000, 10000]:
-        for i in range(1):
-            test_case = generate_test_case(
-                num_locations=num_locations,
-                num_vehicles=1,
-                vehicle_capacity=num_locations*10,
-                time_window_span=None
-            )
-            for solver in [AntColonySolver]:
-                result = test_solver(solver, test_case)
-                # print(result)
-                df.loc[len(df)] = [
-                    num_locations,
-                    solver.__name__,
-                    result[0]['total_time'],
-                    result[0]['total_volume'],
-                    result[0]['compute_time']
-                ]
-                print(df.loc[len(df)-1])
-                df.to_csv('results.csv', index=False)
-
-    print(df.head(20))
-    print(df.info())
-    print(df.describe())
+# Instance families of the benchmark, arguments of generate_test_case except the size and the fleet
+FAMILIES = {
+    "uniform": {"time_window_span": 12},
+    "clustered": {"time_window_span": 12, "num_clusters": 8},
+    "tight_tw": {"time_window_span": 2},
+    "loose_tw": {"time_window_span": None},
+}
+
+# Solvers of the benchmark, each builds a solver for a compiled problem and a seed
+SOLVERS = {
+    "greedy": lambda problem, seed: GreedySolver.from_compiled(problem, logger=Logger()),
+    "ant_colony": lambda problem, seed: AntColonySolver.from_compiled(problem, logger=Logger(), seed=seed),
+}
+
+# Metrics compared with the baseline
+TIME_METRICS = ("wall_time", "cpu_time")
+QUALITY_METRICS = ("cost", "unserved")
+
+
+def generate_benchmark_case(family, num_locations, seed):
+    """
+    Generate a compiled problem of the instance family.
+
+    Args:
+        family: Name of the instance family from FAMILIES
+        num_locations: Number of delivery locations (excluding depot)
+        seed: Seed of the random generator
+
+    Returns:
+        The compiled problem
+    """
+    random.seed(seed)
+    # The fleet grows with the instance, so about ten stops go to each vehicle
+    num_vehicles = max(1, num_locations // 10)
+    test_case = generate_test_case(
+        num_locations=num_locations,
+        num_vehicles=num_vehicles,
+        vehicle_capacity=120,
+        **FAMILIES[family]
+    )
+    return CompiledProblem.from_problem(Problem(vehicle_time_windows=None, **test_case))
+
+
+def solution_stats(routes, problem):
+    """
+    Calculate the quality of the solution.
+
+    Args:
+        routes: Routes returned by the solver, lists of per-stop dicts
+        problem: The compiled problem
+
+    Returns:
+        Dict with the total distance in km, the number of used vehicles and unserved locations
+    """
+    distances = problem.distances
+    cost = 0.0
+    served = set()
+    for route in routes:
+        locs = [stop["loc"] for stop in route]
+        if len(locs) > 1:
+            cost += float(distances[locs[:-1], locs[1:]].sum()) / 1000
+        served.update(locs[1:])
+    return {
+        "cost": cost,
+        "vehicles_used": sum(1 for route in routes if len(route) > 1),
+        "unserved": len(problem) - 1 - len(served),
+        "max_route_time": max((route[-1]["arrival_time"] for route in routes if route), default=0.0)
+    }
+
+
+def run_benchmark_case(solver_name, problem, seed, measure_memory=True):
+    """
+    Solve the problem and measure the run.
+
+    Args:
+        solver_name: Name of the solver from SOLVERS
+        problem: The compiled problem
+        seed: Seed passed to the solver
+        measure_memory: Repeat the run under tracemalloc to get the peak memory
+
+    Returns:
+        Dict of the metrics
+    """
+    wall_start, cpu_start = perf_counter(), process_time()
+    routes = SOLVERS[solver_name](problem, seed).solve()
+    result = {
+        "wall_time": perf_counter() - wall_start,
+        "cpu_time": process_time() - cpu_start,
+        **solution_stats(routes, problem)
+    }
+    if measure_memory:
+        # tracemalloc slows the solvers down, so the memory is measured by a separate run
+        tracemalloc.start()
+        SOLVERS[solver_name](problem, seed).solve()
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmark(families, sizes, solvers, seeds, snapshots_dir=None, measure_memory=True):
+    """
+    Run every solver on every instance.
+
+    Args:
+        families: Names of the instance families
+        sizes: Numbers of delivery locations
+        solvers: Names of the solvers
+        seeds: Seeds of the instances and the solvers
+        snapshots_dir: Directory with problem snapshots of real planning days to run as well
+        measure_memory: Measure the peak memory of each run
+
+    Returns:
+        DataFrame with a row per run
+    """
+    instances = [
+        (family, size, seed, lambda family=family, size=size, seed=seed: generate_benchmark_case(family, size, seed))
+        for family in families for size in sizes for seed in seeds
+    ]
+    if snapshots_dir:
+        for directory, meta in find_snapshots(snapshots_dir):
+            name = os.path.relpath(directory, snapshots_dir)
+            for seed in seeds:
+                instances.append(
+                    (f"snapshot:{name}", meta["size"] - 1, seed, lambda directory=directory: load_snapshot_case(directory))
+                )
+
+    rows = []
+    for family, size, seed, make_problem in instances:
+        problem = make_problem()
+        for solver_name in solvers:
+            result = run_benchmark_case(solver_name, problem, seed, measure_memory)
+            rows.append({"family": family, "num_locations": size, "solver": solver_name, "seed": seed, **result})
+            print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+def summarize(results):
+    """Mean and standard deviation of the metrics over the seeds"""
+    metrics = [c for c in results.columns if c not in ("family", "num_locations", "solver", "seed")]
+    return results.groupby(["family", "num_locations", "solver"])[metrics].agg(["mean", "std"])
+
+
+def baseline_key(family, num_locations, solver):
+    return f"{family}/{num_locations}/{solver}"
+
+
+def make_baseline(results):
+    """Mean metrics of each (family, size, solver) in the JSON baseline format"""
+    means = results.groupby(["family", "num_locations", "solver"]).mean(numeric_only=True)
+    return {
+        baseline_key(family, size, solver): {
+            metric: float(row[metric]) for metric in TIME_METRICS + QUALITY_METRICS if metric in row
+        }
+        for (family, size, solver), row in means.iterrows()
+    }
+
+
+def check_regressions(results, baseline, time_tolerance=0.25, cost_tolerance=0.02, min_time_delta=0.005):
+    """
+    Compare the results with the baseline.
+
+    Args:
+        results: DataFrame returned by run_benchmark
+        baseline: Baseline loaded from the JSON file
+        time_tolerance: Allowed relative growth of the wall and CPU time
+        min_time_delta: Time growth in seconds below which it is timing noise, whatever the relative growth
+        cost_tolerance: Allowed relative growth of the cost
+
+    Returns:
+        List of the regression messages, empty if there are none
+    """
+    regressions = []
+    for key, current in make_baseline(results).items():
+        if key not in baseline:
+            continue
+        reference = baseline[key]
+        for metric in TIME_METRICS:
+            if (
+                    current[metric] > reference[metric] * (1 + time_tolerance)
+                    and current[metric] - reference[metric] > min_time_delta
+            ):
+                regressions.append(f"{key}: {metric} slowed down {reference[metric]:.3f} -> {current[metric]:.3f}")
+        if current["cost"] > reference["cost"] * (1 + cost_tolerance):
+            regressions.append(f"{key}: cost grew {reference['cost']:.3f} -> {current['cost']:.3f}")
+        if current["unserved"] > reference["unserved"]:
+            regressions.append(f"{key}: unserved grew {reference['unserved']:.1f} -> {current['unserved']:.1f}")
+    return regressions
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the VRP solvers")
+    parser.add_argument("--families", nargs="+", default=list(FAMILIES), choices=list(FAMILIES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000])
+    parser.add_argument("--solvers", nargs="+", default=list(SOLVERS), choices=list(SOLVERS))
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0, 1, 2])
+    parser.add_argument("--snapshots", help="Directory with problem snapshots to benchmark as well")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory measurement runs")
+    parser.add_argument("--output", default="results.csv", help="CSV file with a row per run")
+    parser.add_argument("--baseline", help="JSON baseline file to check the results against")
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results to the baseline file")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--cost-tolerance", type=float, default=0.02)
+    parser.add_argument(
+        "--min-time-delta", type=float, default=0.005, help="Smallest time growth in seconds reported as a slowdown"
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    results = run_benchmark(
+        args.families, args.sizes, args.solvers, args.seeds, args.snapshots, measure_memory=not args.no_memory
+    )
+    results.to_csv(args.output, index=False)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(summarize(results))
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(make_baseline(results), f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = check_regressions(
+        results, baseline, args.time_tolerance, args.cost_tolerance, args.min_time_delta
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print("No regressions against the baseline")
+    return 1 if regressions else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Checks that the measured travel times reach the time windows of the planned routes.
+
+An order 3 km away from the depot must be delivered in the first 45 minutes of the day. The flat travel model
+drives there at night speed and serves it, while the segment statistics say the road is driven at 2 km/h,
+so DeliveryPlanner has to leave the order unserved.
+Usage: python -m source.check_travel_times
+"""
+import datetime
+import sys
+from dataclasses import replace
+
+from source.adapters.database.database_sqlite import DatabaseSQLiteAdapter
+from source.data_operator import DataOperator
+from source.domain.entities import *
+from source.solvers.delivery_planner import DeliveryPlanner
+from source.solvers.greedy_solver import GreedySolver
+
+PLANNING_DATE = datetime.date(2024, 1, 1)
+DISTANCE = 3000.  # meters
+SLOW_SPEED = 2.  # km/h
+TIME_WINDOW = (datetime.time(0), datetime.time(0, 45))
+
+
+def fill_db(db: DatabaseSQLiteAdapter):
+    db.upsert_addresses([
+        Address(id=1, latitude=55.75, longitude=37.6, string_address='depot', machine_address='depot',
+                delivery_zone_id=None),
+        Address(id=2, latitude=55.77, longitude=37.6, string_address='order', machine_address='order',
+                delivery_zone_id=1)
+    ])
+    db.upsert_delivery_zone(DeliveryZone(id=1, name='zone', type='C', depot_id=1))
+    db.upsert_products([Product(id=1, name='product', form_factor=1, dimensions={}, volume=1.)])
+    db.upsert_vehicles([
+        Vehicle(id=1, name='vehicle', category='C', dimensions={}, volume_capacity=10., weight_capacity=1000,
+                depot_id=1)
+    ])
+    db.upsert_orders([
+        Order(id=1, number='1', client_id=None, address_id=2, date=PLANNING_DATE,
+              delivery_time_start=TIME_WINDOW[0], delivery_time_end=TIME_WINDOW[1], comment='', status=0)
+    ])
+    db.insert_order_product(OrderProduct(order_id=1, product_id=1, quantity=1))
+
+    db.insert_segments([Segment(None, 1, 2, DISTANCE), Segment(None, 2, 1, DISTANCE)])
+    duration = DISTANCE / 1000 / SLOW_SPEED * 3600
+    db.insert_segments_statistics([
+        SegmentStatistics(None, segment.id, DISTANCE, duration, PLANNING_DATE, datetime.time(hour),
+                          PLANNING_DATE.weekday(), {})
+        for segment in db.get_segments() for hour in range(24)
+    ])
+
+
+def served(routes) -> set:
+    return {stop["loc"] for route in routes for stop in route if stop["loc"] != 0}
+
+
+def check_travel_times(dataop: DataOperator) -> list[str]:
+    """Returns the failed checks"""
+    failures = []
+    week_day = PLANNING_DATE.weekday()
+    planner = DeliveryPlanner(dataop)
+    area = dataop.from_db()[1]
+
+    flat = replace(dataop.compile_area(area, week_day), speed_profiles=None, speed_profile_rows=None)
+    if not served(planner.build_routes(flat, GreedySolver)):
+        failures.append("the flat travel model doesn't reach the order in time, the check proves nothing")
+
+    result = planner.two_step_strategy([area], week_day)[0]
+    if 1 not in result["zone_routes"]:
+        failures.append("the zone problem was not solved")
+    elif served(result["zone_routes"][1]):
+        failures.append(f"the order is served in time at the measured {SLOW_SPEED} km/h")
+    return failures
+
+
+def main():
+    # Shared in-memory database, every plain ':memory:' connection would get a separate empty one
+    db = DatabaseSQLiteAdapter('file:travel_times?mode=memory&cache=shared&uri=true')
+    db.create_tables()
+    fill_db(db)
+
+    failures = check_travel_times(DataOperator(db, None, None, None))
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    if failures:
+        sys.exit(1)
+    print('OK: the measured travel times make the time window infeasible')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ import json
 from source.data_operator import DataOperator
 from source.adapters.database.database_sqlite import DatabaseSQLiteAdapter
 from source.adapters.external_data.business_api_client import BusinessAPIClient
+from source.adapters.cache.disk_matrix_cache import DiskMatrixCache
+from source.web.job_runner import JobRunner
 
 
 def configure_application(application: Flask) -> None:
@@ -12,9 +14,23 @@ def configure_application(application: Flask) -> None:
     cfg_path = os.path.join(base_path, 'data/config.cfg')
     db_path = os.path.join(base_path, 'data/database.db')
     application.config.from_file(cfg_path, load=json.load)
+    db = DatabaseSQLiteAdapter(db_path, profile=application.config.get("DB_PROFILE", "production"))
+    # Creates the tables of a new database and adds the columns and indexes missing in an older one
+    db.create_tables()
     application.config['DATA_OPERATOR'] = DataOperator(
-        db=DatabaseSQLiteAdapter(db_path),
+        db=db,
         business_data=BusinessAPIClient(application.config["URL_BUSINESS_API"]),
         geo_data=,
-        routing_data=
+        routing_data=,
+        # Matrices of the address sets solved before are loaded from data/matrix_cache until new statistics arrive
+        matrix_cache=DiskMatrixCache(
+            os.path.join(base_path, 'data/matrix_cache'),
+            max_bytes=application.config.get("MATRIX_CACHE_SIZE_MB", 1024) * 2 ** 20
+        )
+    )
+    # Solving and imports run in the background, the results are kept in data/jobs
+    application.config['JOB_RUNNER'] = JobRunner(
+        os.path.join(base_path, 'data/jobs'),
+        num_workers=application.config.get("JOB_WORKERS", 1),
+        cleanup=db.release_connection
     )
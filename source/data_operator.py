@@ -1,8 +1,19 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+
 from source.domain.data_business_interface import BusinessDataInterface
 from source.domain.database_interface import DatabaseInterface
 from source.domain.data_geocoding_interface import GeoDataInterface
 from source.domain.data_routing_interface import RoutingDataInterface
+from source.domain.matrix_cache_interface import MatrixCacheInterface
 from source.domain.entities import *
+from source.solvers.distance_evaluators import (
+    calc_nearest_haversine, create_distance_matrix_from_data, create_travel_time_profile_from_data
+)
 
 
 class DataOperator:
@@ -11,103 +22,235 @@ class DataOperator:
             db: DatabaseInterface,
             business_data: BusinessDataInterface,
             geo_data: GeoDataInterface,
-            routing_data: RoutingDataInterface
+            routing_data: RoutingDataInterface,
+            matrix_cache: MatrixCacheInterface | None = None
     ):
         self.db = db
         self.business_data = business_data
         self.geo_data = geo_data
         self.routing_data = routing_data
+        self.matrix_cache = matrix_cache
 
-    def load_data_from_business_to_db(self, start_date=None, end_date=None):
+    def load_data_from_business_to_db(self, start_date=None, end_date=None, batch_size=500) -> LoadReport:
         """Request all the products, vehicles and available orders with all corresponding data
-        from the business data source and load to the db"""
+        from the business data source and load to the db.
+        Entities are upserted in batches, with one transaction per entity type"""
+        started = perf_counter()
+        report = LoadReport()
 
         all_products = self.business_data.get_all_products()
         all_vehicles = self.business_data.get_all_vehicles()
         available_orders = self.business_data.get_available_orders(start_date, end_date)
 
         # Upserting products to the db
-        for p, product in enumerate(all_products):
-            # This and the following similar constructions inside entity constructor calls
-            # are needed to ignore excessive fields in structures from the business data source
-            # which are not needed in the db
-            self.db.upsert_product(Product(**{k: all_products[p][k] for k in Product.__annotations__.keys()}))
+        # This and the following similar constructions inside entity constructor calls
+        # are needed to ignore excessive fields in structures from the business data source
+        # which are not needed in the db
+        products = [Product(**{k: product[k] for k in Product.__annotations__.keys()}) for product in all_products]
+        report.add("products", *self.db.upsert_products(products, batch_size))
 
         # Upserting vehicles to the db
-        for v, vehicle in enumerate(all_vehicles):
-            self.db.upsert_vehicle(Vehicle(**{k: all_vehicles[v][k] for k in Vehicle.__annotations__.keys()}))
+        vehicles = [Vehicle(**{k: vehicle[k] for k in Vehicle.__annotations__.keys()}) for vehicle in all_vehicles]
+        report.add("vehicles", *self.db.upsert_vehicles(vehicles, batch_size))
 
         # The 'depots' set is for storing the ids of depots which was found in orders structure
         # This is for making sure the address of a depot is requested only once
         depots = set()
-        # Parsing the orders and upserting addresses and orders to the db
-        for o, order in enumerate(available_orders):
-            depot_id = available_orders[o]["depot_id"]
+        depot_addresses = []
+        orders = []
+        # Parsing the orders and collecting addresses and orders for the db
+        for order in available_orders:
+            depot_id = order["depot_id"]
             if depot_id not in depots:
-                depot_address = self.business_data.get_depot(available_orders[o]["depot_id"])
+                depot_address = self.business_data.get_depot(depot_id)
                 depots.add(depot_id)
                 if depot_address:
-                    self.db.upsert_address(Address(**{k: depot_address[k] for k in Address.__annotations__.keys()}))
-            self.db.upsert_order(Order(**{k: available_orders[o][k] for k in Order.__annotations__.keys()}))
+                    depot_addresses.append(Address(**{k: depot_address[k] for k in Address.__annotations__.keys()}))
+            orders.append(Order(**{k: order[k] for k in Order.__annotations__.keys()}))
+        report.add("addresses", *self.db.upsert_addresses(depot_addresses, batch_size))
+        report.add("orders", *self.db.upsert_orders(orders, batch_size))
+
+        report.elapsed_time = perf_counter() - started
+        return report
 
     def load_data_from_geocoding_to_db(self):
         """Request all the addresses from the db and geocode them using the geocoding data source"""
         addresses = self.db.get_ungeocoded_addresses()
         for a, address in enumerate(addresses):
             address.latitude, address.longitude = self.geo_data.geocode(address.machine_address)
-            self.db.upsert_address(address)
+        self.db.upsert_addresses(addresses)
+
+    def generate_segments(self, addresses_ids: list[int], num_neighbors=10, batch_size=500) -> int:
+        """Create the segments from each of the given addresses to its num_neighbors nearest geocoded addresses
+        and back, with the direct (great circle) distance. The neighbors of all the addresses are found
+        with one KD-tree query and the missing segments are inserted in batches.
+        Returns the number of inserted segments"""
+        addresses = [
+            address for address in self.db.get_addresses()
+            if address.latitude is not None and address.longitude is not None
+        ]
+        ids = np.array([address.id for address in addresses], dtype=np.int64)
+        locations = np.array([(address.latitude, address.longitude) for address in addresses], dtype=np.float64)
+        new = np.flatnonzero(np.isin(ids, np.asarray(addresses_ids, dtype=np.int64)))
+        if len(new) == 0:
+            return 0
+
+        # One extra neighbor is requested, as the address itself is one of the results
+        closest, distances = calc_nearest_haversine(locations[new], locations, num_neighbors + 1)
+        pairs = {}
+        for row, i in enumerate(new):
+            neighbors = [(j, d) for j, d in zip(closest[row], distances[row]) if j != i][:num_neighbors]
+            for j, direct_distance in neighbors:
+                pairs[(ids[i], ids[j])] = direct_distance
+                pairs[(ids[j], ids[i])] = direct_distance
 
-    def load_data_from_routing_to_db(self, addresses_ids=None, only_unrouted=True):
-        """Request all the unrouted segments from the db and get the routing data using the routing data source"""
+        segments = [
+            Segment(id=None, address_1_id=int(a), address_2_id=int(b), direct_distance=float(direct_distance))
+            for (a, b), direct_distance in pairs.items()
+        ]
+        with self.db.transaction():
+            return self.db.insert_segments(segments, batch_size)
+
+    def load_data_from_routing_to_db(self, addresses_ids=None, only_unrouted=True, tile_size=None) -> int:
+        """Request the routing data of the segments with matrix requests, a source x destination tile per request,
+        and save the statistics with a transaction per tile. Returns the number of saved statistics records"""
         # If true, only segments without statistical data will be requested from the db
         # If false, all segments will be requested from the db
         if only_unrouted:
             segments = self.db.get_unrouted_segments(addresses_ids)
         else:
             segments = self.db.get_segments(addresses_ids)
+        if not segments:
+            return 0
+
+        used_ids = {segment.address_1_id for segment in segments} | {segment.address_2_id for segment in segments}
+        addresses = {address.id: address for address in self.db.get_addresses(sorted(used_ids))}
+
+        # Up to max_in_flight tiles are requested at once, the statistics are saved by this thread as they arrive.
+        # Each tile is committed on its own, so an interrupted or partly failed run leaves only
+        # the remaining segments unrouted and the next run with only_unrouted continues from them
+        tiles = self.routing_tiles(segments, tile_size or self.routing_data.max_matrix_size)
+        saved = 0
+        failed = 0
+        pool = ThreadPoolExecutor(max_workers=self.routing_data.max_in_flight, thread_name_prefix="routing")
+        try:
+            futures = [pool.submit(self.request_routing_tile, tile, addresses) for tile in tiles]
+            for future in as_completed(futures):
+                try:
+                    statistics = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"Routing error: tile request failed with {e!r}")
+                    continue
+                with self.db.transaction():
+                    saved += self.db.insert_segments_statistics(statistics)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if failed:
+            print(f"Routing error: {failed} of {len(tiles)} tiles failed, their segments are left unrouted")
+        return saved
+
+    @staticmethod
+    def routing_tiles(segments: list[Segment], tile_size: int) -> list[tuple[list[int], list[int], list[Segment]]]:
+        """Groups the segments into tiles of at most tile_size sources and tile_size destinations.
+        Sources are chunked first and each chunk gets only the destinations its segments need,
+        so a full matrix of n addresses takes (n / tile_size) ** 2 requests"""
+        by_source = defaultdict(list)
+        for segment in segments:
+            by_source[segment.address_1_id].append(segment)
+        sources = sorted(by_source)
 
-        for s, segment in enumerate(segments):
-            source = self.db.get_address(segment.address_1_id)
-            destination = self.db.get_address(segment.address_2_id)
-            segment_data = self.routing_data.get_segment_data(
-                (source.latitude, source.longitude),
-                (destination.latitude, destination.longitude),
-                segment.id
-            )
-            self.db.insert_segment_statistics(SegmentStatistics(**segment_data))
-
-    def from_db(self):
-        """Loads and builds the transportation problem data from the db"""
-        """locations: list = []
-        loc_delivery_zones: list = []
-        addresses: list = []
-        demands: list = [0]
-        volumes: list = [0]
-        time_windows: list = []
-        vehicle_capacities: list = []
-        vehicle_time_windows: list = []"""
+        tiles = []
+        for start in range(0, len(sources), tile_size):
+            by_destination = defaultdict(list)
+            for source_id in sources[start:start + tile_size]:
+                for segment in by_source[source_id]:
+                    by_destination[segment.address_2_id].append(segment)
+            destinations = sorted(by_destination)
+            for d_start in range(0, len(destinations), tile_size):
+                tile_destinations = destinations[d_start:d_start + tile_size]
+                tile_segments = [segment for d in tile_destinations for segment in by_destination[d]]
+                tile_sources = sorted({segment.address_1_id for segment in tile_segments})
+                tiles.append((tile_sources, tile_destinations, tile_segments))
+        return tiles
+
+    def request_routing_tile(
+            self, tile: tuple[list[int], list[int], list[Segment]], addresses: dict
+    ) -> list[SegmentStatistics]:
+        """Requests the matrix of the tile and returns the statistics of its segments.
+        Runs in the routing threads, so it doesn't use the db"""
+        sources, destinations, segments = tile
+        distances, durations = self.routing_data.get_matrix_data(
+            [(addresses[a].latitude, addresses[a].longitude) for a in sources],
+            [(addresses[a].latitude, addresses[a].longitude) for a in destinations]
+        )
+        rows = {address_id: i for i, address_id in enumerate(sources)}
+        columns = {address_id: j for j, address_id in enumerate(destinations)}
+
+        requested_at = datetime.now()
+        statistics = []
+        for segment in segments:
+            i, j = rows[segment.address_1_id], columns[segment.address_2_id]
+            # Unroutable pairs stay unrouted and are requested again by the next run
+            if distances[i][j] is None or durations[i][j] is None:
+                continue
+            statistics.append(SegmentStatistics(
+                record_id=None,
+                segment_id=segment.id,
+                distance=distances[i][j],
+                duration=durations[i][j],
+                date=requested_at.date(),
+                start_time=requested_at.time(),
+                week_day=requested_at.weekday(),
+                json_response={"source": type(self.routing_data).__name__}
+            ))
+        return statistics
+
+    def distance_matrix(self, addresses: list[Address], aggregate='latest') -> DistanceMatrix:
+        """Distance and duration matrices between the addresses, from the matrix cache when it's up to date"""
+        return create_distance_matrix_from_data(addresses, self.db, aggregate, cache=self.matrix_cache)
+
+    def from_db(self, status=0):
+        """Loads and builds the transportation problem data from the db.
+        Orders of each area come with their locations, volumes and time windows in columns"""
         depots = self.db.get_depots()
-        areas = {
-            d.id: {
-                "depot_address": d,
-                "orders": [],
-                "order_products": [],
-                "delivery_zones": [],
-                "addresses": [],
-                "vehicles": []
-            } for d in depots
+        areas = {}
+        for depot in depots:
+            areas[depot.id] = {
+                "depot_address": depot,
+                "delivery_zones": self.db.get_delivery_zones(depot_id=depot.id),
+                "vehicles": self.db.get_vehicles(depot_id=depot.id),
+                "orders": self.db.get_area_orders(depot.id, status=status)
+            }
+        return areas
+
+    def compile_area(self, area: dict, week_day: int | None = None, aggregate='latest') -> CompiledProblem:
+        """Compiles the problem of an area returned by from_db: the depot first, then a stop per order.
+        Distances come from the segment statistics (through the matrix cache) and the travel times
+        from the speed profiles measured on the week day of planning, today's by default"""
+        depot: Address = area["depot_address"]
+        orders: AreaOrders = area["orders"]
+        vehicles: list[Vehicle] = area["vehicles"]
+        if week_day is None:
+            week_day = datetime.now().weekday()
+
+        order_addresses = {
+            address.id: address for address in self.db.get_addresses(np.unique(orders.address_ids).tolist())
         }
-        for d, depot in enumerate(depots):
-            areas[depot.id]["delivery_zones"] = self.db.get_delivery_zones(depot_id=depot.id)
-            areas[depot.id]["vehicles"] = self.db.get_vehicles(depot_id=depot.id)
-            areas[depot.id]["orders"] = self.db.get_orders(depot_id=depot.id, status=0)
-            for o, order in enumerate(areas[depot.id]["orders"]):
-                order_products = self.db.get_order_products(order.id)
-                volumes = []
-                for op in order_products:
-                    volume = self.db.get_product(op.product_id).volume * op.quantity
-                    volumes.append(volume)
-                areas[depot.id]["order_products"].append(volumes)
-                areas[depot.id]["addresses"].append(self.db.get_address(order.address_id))
+        addresses = [depot] + [order_addresses[address_id] for address_id in orders.address_ids.tolist()]
+        # Orders without a delivery time can be delivered at any time of the day
+        time_windows = np.where(np.isnan(orders.time_windows), [0., 24.], orders.time_windows)
 
-        return areas
+        problem = Problem(
+            locations=[(depot.latitude, depot.longitude)] + orders.locations.tolist(),
+            # An order is a single stop, its volume is the total volume of its products
+            demands=[0] + [1] * len(orders),
+            volumes=[0.] + orders.volumes.tolist(),
+            time_windows=[(0., 24.)] + time_windows.tolist(),
+            vehicle_capacities=[vehicle.volume_capacity for vehicle in vehicles],
+            vehicle_time_windows=None,
+            distance_evaluator=self.distance_matrix(addresses, aggregate)
+        )
+        return CompiledProblem.from_problem(
+            problem, travel_time_profile=create_travel_time_profile_from_data(addresses, self.db, week_day)
+        )
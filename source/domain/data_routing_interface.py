@@ -2,6 +2,25 @@ from abc import ABC, abstractmethod
 
 
 class RoutingDataInterface(ABC):
+    # Largest number of sources (and of destinations) the routing source accepts in one matrix request
+    max_matrix_size = 50
+    # Number of requests which may be sent at once, sources without own rate limiting should keep 1
+    max_in_flight = 1
+
     @abstractmethod
     def get_segment_data(self, source: tuple[float, float], destination: tuple[float, float], segment_id) -> dict:
         pass
+
+    def get_matrix_data(
+            self, sources: list[tuple[float, float]], destinations: list[tuple[float, float]]
+    ) -> tuple[list[list[float | None]], list[list[float | None]]]:
+        """Returns distances (meters) and durations from each source to each destination, None for unroutable pairs.
+        Sources with matrix APIs should override this, the default makes a segment request per pair"""
+        distances = [[None] * len(destinations) for _ in sources]
+        durations = [[None] * len(destinations) for _ in sources]
+        for i, source in enumerate(sources):
+            for j, destination in enumerate(destinations):
+                segment_data = self.get_segment_data(source, destination, None)
+                distances[i][j] = segment_data.get("distance")
+                durations[i][j] = segment_data.get("duration")
+        return distances, durations
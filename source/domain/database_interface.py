@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 from source.domain.entities.address import Address
+from source.domain.entities.area_orders import AreaOrders
 from source.domain.entities.client import Client
 from source.domain.entities.delivery_zone import DeliveryZone
 from source.domain.entities.order import Order
@@ -20,6 +23,19 @@ class DatabaseInterface(ABC):
     def create_tables(self):
         pass
 
+    @abstractmethod
+    def transaction(self):
+        """Context manager committing all the writes inside it at once"""
+        pass
+
+    @abstractmethod
+    def set_read_only(self, read_only: bool):
+        pass
+
+    @abstractmethod
+    def release_connection(self):
+        pass
+
     # ***************************
     # Address
     # ***************************
@@ -31,12 +47,17 @@ class DatabaseInterface(ABC):
     def upsert_address(self, address: Address):
         pass
 
+    @abstractmethod
+    def upsert_addresses(self, addresses: list[Address], batch_size: int = 500) -> tuple[int, int]:
+        """Returns the numbers of inserted and updated rows"""
+        pass
+
     @abstractmethod
     def get_address(self, address_id: int) -> Address:
         pass
 
     @abstractmethod
-    def get_addresses(self) -> list[Address]:
+    def get_addresses(self, addresses_ids: list[int] | None = None) -> list[Address]:
         pass
 
     @abstractmethod
@@ -92,6 +113,10 @@ class DatabaseInterface(ABC):
     def upsert_order(self, order: Order):
         pass
 
+    @abstractmethod
+    def upsert_orders(self, orders: list[Order], batch_size: int = 500) -> tuple[int, int]:
+        pass
+
     @abstractmethod
     def get_order(self, order_id: int) -> Order:
         pass
@@ -100,6 +125,11 @@ class DatabaseInterface(ABC):
     def get_orders(self, status=None, depot_id=-1, start_date=None, end_date=None) -> list[Order]:
         pass
 
+    @abstractmethod
+    def get_area_orders(self, depot_id: int, status: int | None = 0) -> AreaOrders:
+        """Orders of the depot area with their addresses and total volumes, in columns"""
+        pass
+
     @abstractmethod
     def insert_order_product(self, order_product: OrderProduct):
         pass
@@ -123,6 +153,10 @@ class DatabaseInterface(ABC):
     def upsert_product(self, product: Product):
         pass
 
+    @abstractmethod
+    def upsert_products(self, products: list[Product], batch_size: int = 500) -> tuple[int, int]:
+        pass
+
     @abstractmethod
     def get_product(self, product_id: int) -> Product:
         pass
@@ -149,26 +183,50 @@ class DatabaseInterface(ABC):
     def insert_segment(self, segment: Segment):
         pass
 
+    @abstractmethod
+    def insert_segments(self, segments: list[Segment], batch_size: int = 500) -> int:
+        """Inserts the missing segments, returns the number of inserted and filled segments"""
+        pass
+
     @abstractmethod
     def get_segment(self, address_1_id: int, address_2_id: int) -> Segment:
         pass
 
     @abstractmethod
-    def get_segments(self, addresses_ids: list[int]) -> list[Segment]:
+    def get_segments(self, addresses_ids: list[int] | None = None) -> list[Segment]:
         pass
 
     @abstractmethod
-    def get_unrouted_segments(self, addresses_ids: list[int]) -> list[Segment]:
+    def get_unrouted_segments(self, addresses_ids: list[int] | None = None) -> list[Segment]:
         pass
 
     @abstractmethod
     def insert_segment_statistics(self, segment_statistics: SegmentStatistics):
         pass
 
+    @abstractmethod
+    def insert_segments_statistics(self, statistics: list[SegmentStatistics], batch_size: int = 500) -> int:
+        """Returns the number of inserted rows"""
+        pass
+
     @abstractmethod
     def get_segment_statistics(self, segment_id: int) -> list[SegmentStatistics]:
         pass
 
+    @abstractmethod
+    def get_segment_statistics_version(self) -> int:
+        pass
+
+    @abstractmethod
+    def get_segments_statistics_matrices(
+            self, addresses_ids: list[int], aggregate: str = 'latest'
+    ) -> tuple[np.ndarray, np.ndarray]:
+        pass
+
+    @abstractmethod
+    def get_segment_statistics_records(self, addresses_ids: list[int]) -> dict[str, np.ndarray]:
+        pass
+
     # ***************************
     # Vehicle
     # ***************************
@@ -180,6 +238,10 @@ class DatabaseInterface(ABC):
     def upsert_vehicle(self, vehicle: Vehicle):
         pass
 
+    @abstractmethod
+    def upsert_vehicles(self, vehicles: list[Vehicle], batch_size: int = 500) -> tuple[int, int]:
+        pass
+
     @abstractmethod
     def get_vehicle(self, vehicle_id: int) -> Vehicle:
         pass
@@ -9,6 +9,12 @@ from source.domain.entities.segment import Segment
 from source.domain.entities.segment_statistics import SegmentStatistics
 from source.domain.entities.vehicle import Vehicle
 from source.domain.entities.problem import Problem
+from source.domain.entities.distance_matrix import DistanceMatrix
+from source.domain.entities.solution import RouteStops, Solution
+from source.domain.entities.load_report import LoadReport
+from source.domain.entities.area_orders import AreaOrders
+from source.domain.entities.compiled_problem import CompiledProblem
+from source.domain.entities.travel_time_profile import TravelTimeProfile
 __all__ = [
     "Address",
     "Client",
@@ -20,5 +26,12 @@ __all__ = [
     "Segment",
     "SegmentStatistics",
     "Vehicle",
-    "Problem"
+    "Problem",
+    "DistanceMatrix",
+    "RouteStops",
+    "Solution",
+    "LoadReport",
+    "AreaOrders",
+    "CompiledProblem",
+    "TravelTimeProfile"
 ]
@@ -0,0 +1,28 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class AreaOrders:
+    """Orders of a depot area stored in columns, the arrays are aligned by the order position"""
+    order_ids: np.ndarray
+    address_ids: np.ndarray
+    delivery_zone_ids: np.ndarray
+    locations: np.ndarray  # (latitude, longitude) of the order address
+    volumes: np.ndarray  # Total volume of the order products, product volume multiplied by quantity
+    time_windows: np.ndarray  # Delivery time start and end in hours
+
+    def __len__(self):
+        return len(self.order_ids)
+
+    def select(self, mask) -> "AreaOrders":
+        """Orders by a boolean mask or an array of positions"""
+        return AreaOrders(
+            order_ids=self.order_ids[mask],
+            address_ids=self.address_ids[mask],
+            delivery_zone_ids=self.delivery_zone_ids[mask],
+            locations=self.locations[mask],
+            volumes=self.volumes[mask],
+            time_windows=self.time_windows[mask]
+        )
@@ -0,0 +1,138 @@
+import datetime
+import json
+import os
+from dataclasses import dataclass, fields
+
+import numpy as np
+
+from source.domain.entities.distance_matrix import DistanceMatrix
+from source.domain.entities.problem import Problem
+from source.domain.entities.travel_time_profile import TravelTimeProfile
+
+# Handling time of a single product at the location, hours
+PRODUCT_SERVICE_TIME = 30 / 3600
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_META_FILE = "meta.json"
+# Arrays which are not float64
+FIELD_DTYPES = {
+    "distances": np.float32,
+    "durations": np.float32,
+    "speed_profiles": np.float32,
+    "speed_profile_rows": np.int32
+}
+
+
+def to_hours(value) -> float:
+    """Hours since midnight of a time, hours are passed as they are"""
+    if isinstance(value, (datetime.time, datetime.datetime)):
+        return value.hour + value.minute / 60 + value.second / 3600
+    return float(value)
+
+
+@dataclass(frozen=True)
+class CompiledProblem:
+    """Solver-ready problem: everything the solvers need is derived once and stored in read-only arrays"""
+    locations: np.ndarray  # (n, 2) coordinates, the depot first
+    demands: np.ndarray  # Number of products for each location
+    volumes: np.ndarray  # Total volume of products for each location
+    service_times: np.ndarray  # Product handling time for each location, hours
+    time_windows: np.ndarray  # (n, 2) start and end, hours
+    vehicle_capacities: np.ndarray
+    vehicle_time_windows: np.ndarray  # (m, 2) shift start and end, hours
+    distances: np.ndarray  # (n, n) meters
+    durations: np.ndarray | None = None
+    # Travel time profile of the planning day, see TravelTimeProfile: speeds per hour bucket and row of each pair
+    speed_profiles: np.ndarray | None = None
+    speed_profile_rows: np.ndarray | None = None
+
+    def __post_init__(self):
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if value is None:
+                continue
+            dtype = FIELD_DTYPES.get(field.name, np.float64)
+            # A view is made read-only, so arrays of the same type (e.g. memory-mapped ones) are not copied
+            # and the caller's own array stays writable
+            array = np.asarray(value, dtype=dtype).view()
+            array.flags.writeable = False
+            object.__setattr__(self, field.name, array)
+
+    def __len__(self):
+        return len(self.locations)
+
+    @property
+    def vehicle_count(self) -> int:
+        return len(self.vehicle_capacities)
+
+    def distance_matrix(self) -> DistanceMatrix:
+        return DistanceMatrix(distances=self.distances, durations=self.durations)
+
+    def travel_time_profile(self) -> TravelTimeProfile | None:
+        if self.speed_profiles is None:
+            return None
+        return TravelTimeProfile(speeds=self.speed_profiles, node_rows=self.speed_profile_rows)
+
+    @classmethod
+    def from_problem(
+            cls,
+            problem: Problem,
+            product_service_time: float = PRODUCT_SERVICE_TIME,
+            travel_time_profile: TravelTimeProfile | None = None
+    ):
+        """Compiles the problem built from the db entities"""
+        size = len(problem.locations)
+        demands = np.asarray(problem.demands, dtype=np.float64)
+        evaluator = problem.distance_evaluator
+        matrix = evaluator if isinstance(evaluator, DistanceMatrix) else DistanceMatrix.from_evaluator(evaluator, size)
+        vehicle_time_windows = problem.vehicle_time_windows or [(0, 24)] * len(problem.vehicle_capacities)
+
+        return cls(
+            locations=np.asarray(problem.locations, dtype=np.float64).reshape(size, -1),
+            demands=demands,
+            volumes=demands * np.asarray(problem.volumes, dtype=np.float64),
+            service_times=demands * product_service_time,
+            time_windows=[(to_hours(start), to_hours(end)) for start, end in problem.time_windows],
+            vehicle_capacities=problem.vehicle_capacities,
+            vehicle_time_windows=[(to_hours(start), to_hours(end)) for start, end in vehicle_time_windows],
+            distances=matrix.distances,
+            durations=matrix.durations,
+            speed_profiles=travel_time_profile.speeds if travel_time_profile is not None else None,
+            speed_profile_rows=travel_time_profile.node_rows if travel_time_profile is not None else None
+        )
+
+    def save_snapshot(self, directory, meta: dict | None = None):
+        """Saves the problem as a directory of .npy files, one per array, which can be memory-mapped on load.
+        The meta (e.g. the date and the depot of a planning day) is saved to meta.json"""
+        os.makedirs(directory, exist_ok=True)
+        arrays = []
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if value is None:
+                continue
+            np.save(os.path.join(directory, f"{field.name}.npy"), value)
+            arrays.append(field.name)
+        with open(os.path.join(directory, SNAPSHOT_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": SNAPSHOT_FORMAT_VERSION,
+                "arrays": arrays,
+                "size": len(self),
+                "vehicle_count": self.vehicle_count,
+                "meta": meta or {}
+            }, f, ensure_ascii=False, indent=2, default=str)
+
+    @classmethod
+    def load_snapshot(cls, directory, mmap=True):
+        """Loads a snapshot, the arrays are memory-mapped unless mmap is False,
+        so only the parts of the matrices used by a solver are read from the disk"""
+        meta = read_snapshot_meta(directory)
+        if meta["format_version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format version: {meta['format_version']}")
+        mmap_mode = "r" if mmap else None
+        return cls(**{
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in meta["arrays"]
+        })
+
+
+def read_snapshot_meta(directory) -> dict:
+    with open(os.path.join(directory, SNAPSHOT_META_FILE), encoding="utf-8") as f:
+        return json.load(f)
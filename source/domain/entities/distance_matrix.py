@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+# Upper bound on the number of pairwise elements computed at once, keeps temporary arrays around 32 MB
+BLOCK_ELEMENTS = 4_000_000
+
+
+def _block_rows(size: int) -> int:
+    return max(1, BLOCK_ELEMENTS // max(size, 1))
+
+
+@dataclass
+class DistanceMatrix:
+    distances: np.ndarray
+    durations: np.ndarray | None = None
+
+    def __post_init__(self):
+        # Solvers index these arrays directly in their inner loops, so keep them dense and compact
+        self.distances = np.ascontiguousarray(self.distances, dtype=np.float32)
+        if self.durations is not None:
+            self.durations = np.ascontiguousarray(self.durations, dtype=np.float32)
+
+    def __len__(self):
+        return self.distances.shape[0]
+
+    def __call__(self, from_node, to_node):
+        """Makes the matrix usable wherever a distance evaluator callable is expected"""
+        return self.distances[from_node, to_node]
+
+    def nearest_neighbors(self, k: int) -> np.ndarray:
+        """Indices of the k closest other locations for every location, ordered by distance"""
+        size = len(self)
+        k = max(0, min(k, size - 1))
+        neighbors = np.empty((size, k), dtype=np.int32)
+        if k == 0:
+            return neighbors
+
+        # Rows are processed in blocks to keep the temporary copies small on large matrices
+        step = _block_rows(size)
+        for start in range(0, size, step):
+            block = np.array(self.distances[start:start + step], dtype=np.float64)
+            rows = np.arange(block.shape[0])
+            block[rows, rows + start] = np.inf  # The location itself is never its own neighbor
+            closest = np.argpartition(block, k - 1, axis=1)[:, :k]
+            order = np.take_along_axis(block, closest, axis=1).argsort(axis=1, kind="stable")
+            neighbors[start:start + step] = np.take_along_axis(closest, order, axis=1)
+        return neighbors
+
+    @classmethod
+    def from_evaluator(cls, distance_evaluator, size: int):
+        """Evaluates the pairwise distances once, so the solvers never call the evaluator again"""
+        distances = np.zeros((size, size), dtype=np.float32)
+        for i in range(size):
+            for j in range(size):
+                if i != j:
+                    distances[i, j] = distance_evaluator(i, j)
+        return cls(distances=distances)
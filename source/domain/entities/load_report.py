@@ -0,0 +1,21 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class LoadReport:
+    # Numbers of rows per entity type, e.g. {"orders": 120}
+    inserted: dict = field(default_factory=dict)
+    updated: dict = field(default_factory=dict)
+    elapsed_time: float = 0.0  # seconds
+
+    def add(self, entity_type: str, inserted: int, updated: int):
+        self.inserted[entity_type] = self.inserted.get(entity_type, 0) + inserted
+        self.updated[entity_type] = self.updated.get(entity_type, 0) + updated
+
+    @property
+    def total_inserted(self) -> int:
+        return sum(self.inserted.values())
+
+    @property
+    def total_updated(self) -> int:
+        return sum(self.updated.values())
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class RouteStops:
+    """Stops of a single vehicle route stored in parallel arrays instead of a list of per-stop dicts"""
+    __slots__ = ("locs", "arrival_times", "wait_times", "loads", "size", "_shared")
+
+    def __init__(self, capacity: int = 16):
+        self.locs = np.empty(capacity, dtype=np.int32)
+        self.arrival_times = np.empty(capacity, dtype=np.float64)
+        self.wait_times = np.empty(capacity, dtype=np.float64)
+        self.loads = np.empty(capacity, dtype=np.float64)
+        self.size = 0
+        # Set when the arrays are used by a clone as well, the first write then copies them
+        self._shared = False
+
+    @classmethod
+    def from_depot(cls, depot: int = 0, start_time: float = 0.0, capacity: int = 16):
+        route = cls(capacity)
+        route.append(depot, start_time, 0.0, 0.0)
+        return route
+
+    @classmethod
+    def from_dicts(cls, stops: list[dict]):
+        route = cls(max(len(stops), 1))
+        for stop in stops:
+            route.append(stop["loc"], stop["arrival_time"], stop["wait_time"], stop["load"])
+        return route
+
+    def _reallocate(self, capacity: int):
+        for name in ("locs", "arrival_times", "wait_times", "loads"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self._shared = False
+
+    def append(self, loc, arrival_time, wait_time, load):
+        if self.size == len(self.locs):
+            self._reallocate(max(2 * len(self.locs), 16))
+        elif self._shared:
+            self._reallocate(len(self.locs))
+        i = self.size
+        self.locs[i] = loc
+        self.arrival_times[i] = arrival_time
+        self.wait_times[i] = wait_time
+        self.loads[i] = load
+        self.size += 1
+
+    def copy(self):
+        """Cheap clone sharing the arrays until one of the routes is changed"""
+        clone = RouteStops.__new__(RouteStops)
+        clone.locs = self.locs
+        clone.arrival_times = self.arrival_times
+        clone.wait_times = self.wait_times
+        clone.loads = self.loads
+        clone.size = self.size
+        clone._shared = self._shared = True
+        return clone
+
+    @property
+    def last_loc(self) -> int:
+        return int(self.locs[self.size - 1])
+
+    def stop_locs(self) -> np.ndarray:
+        return self.locs[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i) -> dict:
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError("route stop index out of range")
+        return {
+            "loc": int(self.locs[i]),
+            "arrival_time": float(self.arrival_times[i]),
+            "wait_time": float(self.wait_times[i]),
+            "load": float(self.loads[i])
+        }
+
+    def __iter__(self):
+        return (self[i] for i in range(self.size))
+
+    def to_dicts(self) -> list[dict]:
+        """Converts the route to the list of per-stop dicts used by the web layer and export"""
+        return [
+            {"loc": loc, "arrival_time": arrival_time, "wait_time": wait_time, "load": load}
+            for loc, arrival_time, wait_time, load in zip(
+                self.locs[:self.size].tolist(),
+                self.arrival_times[:self.size].tolist(),
+                self.wait_times[:self.size].tolist(),
+                self.loads[:self.size].tolist()
+            )
+        ]
+
+    def __getstate__(self):
+        # Only the used part of the arrays is sent to other processes
+        return (
+            self.locs[:self.size].copy(), self.arrival_times[:self.size].copy(),
+            self.wait_times[:self.size].copy(), self.loads[:self.size].copy()
+        )
+
+    def __setstate__(self, state):
+        self.locs, self.arrival_times, self.wait_times, self.loads = state
+        self.size = len(self.locs)
+        self._shared = False
+
+
+class Solution:
+    """Routes of all the vehicles"""
+    __slots__ = ("routes",)
+
+    def __init__(self, routes: list[RouteStops]):
+        self.routes = routes
+
+    @classmethod
+    def from_dicts(cls, routes: list[list[dict]]):
+        return cls([RouteStops.from_dicts(route) for route in routes])
+
+    def copy(self):
+        return Solution([route.copy() for route in self.routes])
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __getitem__(self, v) -> RouteStops:
+        return self.routes[v]
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def to_dicts(self) -> list[list[dict]]:
+        return [route.to_dicts() for route in self.routes]
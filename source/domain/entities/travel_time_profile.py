@@ -0,0 +1,76 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+
+import numpy as np
+
+HOURS_PER_DAY = 24
+
+
+@dataclass
+class TravelTimeProfile:
+    """Time dependent speeds for a planning day: a row of speeds per hour bucket (km/h) for each profile.
+    Row 0 is the global profile used by the pairs of locations without their own one.
+
+    Travel times integrate the speed over the buckets crossed on the way, so leaving later never means
+    arriving earlier (FIFO). Positions along the day's cumulative distance are precomputed per row,
+    so a lookup is a bisection over the buckets, whatever the number of buckets crossed.
+    """
+    speeds: np.ndarray  # (profiles, buckets) km/h
+    node_rows: np.ndarray | None = None  # (n, n) row of speeds for each pair of locations, 0 for the global one
+
+    def __post_init__(self):
+        self.speeds = np.ascontiguousarray(self.speeds, dtype=np.float32).reshape(-1, np.shape(self.speeds)[-1])
+        if np.any(self.speeds <= 0):
+            raise ValueError("Travel time profile speeds must be positive")
+        if self.node_rows is not None:
+            self.node_rows = np.ascontiguousarray(self.node_rows, dtype=np.int32)
+        buckets = self.speeds.shape[1]
+        self.bucket_hours = HOURS_PER_DAY / buckets
+        # Distance covered since the start of the day at each bucket border, km
+        self.cumulative = np.zeros((len(self.speeds), buckets + 1), dtype=np.float32)
+        np.cumsum(self.speeds * np.float32(self.bucket_hours), axis=1, out=self.cumulative[:, 1:])
+        self.min_speeds = self.speeds.min(axis=1)
+        # Most pairs use the global profile, its row is kept in lists for the scalar reads of the solvers
+        self.global_speeds = self.speeds[0].tolist()
+        self.global_cumulative = self.cumulative[0].tolist()
+
+    def __len__(self):
+        return len(self.speeds)
+
+    def row(self, from_node, to_node) -> int:
+        return 0 if self.node_rows is None else self.node_rows.item(from_node, to_node)
+
+    def travel_time(self, from_node, to_node, distance: float, start_time: float) -> float:
+        """Hours to drive the distance (km) between the nodes leaving at start_time (hours, may exceed 24)"""
+        if distance <= 0:
+            return 0.
+        if distance == float('inf'):
+            # Segments without statistics are unreachable at any time
+            return distance
+        r = 0 if self.node_rows is None else self.node_rows.item(from_node, to_node)
+        if r == 0:
+            speeds, cumulative = self.global_speeds, self.global_cumulative
+        else:
+            # Rows of the segments are read from the arrays, only the few touched elements become floats
+            speeds, cumulative = self.speeds[r], self.cumulative[r]
+        h = self.bucket_hours
+        last = len(speeds) - 1
+
+        days, time_of_day = divmod(start_time, HOURS_PER_DAY)
+        b = min(int(time_of_day / h), last)
+        # Position along the day's cumulative distance at the departure and at the arrival
+        target = float(cumulative[b]) + (time_of_day - b * h) * float(speeds[b]) + distance
+        extra_days, target = divmod(target, float(cumulative[-1]))
+        b = min(bisect_right(cumulative, target) - 1, last)
+        arrival = (days + extra_days) * HOURS_PER_DAY + b * h + (target - float(cumulative[b])) / float(speeds[b])
+        return arrival - start_time
+
+    def max_travel_time(self, from_node, to_node, distance: float) -> float:
+        """Travel time at the slowest speed of the day, an upper bound of travel_time"""
+        return distance / self.min_speeds.item(self.row(from_node, to_node))
+
+    @classmethod
+    def from_velocities(cls, base_velocity: float, min_velocity: float, rush_hours=(8, 23)):
+        """The flat model: base velocity at night and the minimal velocity during the rush hours"""
+        speeds = [min_velocity if rush_hours[0] <= hour < rush_hours[1] else base_velocity for hour in range(24)]
+        return cls(speeds=np.array([speeds]))
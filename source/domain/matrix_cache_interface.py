@@ -0,0 +1,13 @@
+from abc import ABC, abstractmethod
+
+from source.domain.entities.distance_matrix import DistanceMatrix
+
+
+class MatrixCacheInterface(ABC):
+    @abstractmethod
+    def get(self, key: str) -> DistanceMatrix | None:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, matrix: DistanceMatrix):
+        pass
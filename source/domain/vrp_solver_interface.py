@@ -1,8 +1,49 @@
 from abc import ABC, abstractmethod
+from bisect import bisect_right
+from itertools import compress
+
 from source.domain.logger_interface import LoggerInterface
+from source.domain.entities.distance_matrix import DistanceMatrix
+from source.domain.entities.compiled_problem import CompiledProblem
+from source.domain.entities.solution import RouteStops
+from source.domain.entities.travel_time_profile import TravelTimeProfile
+
+
+class CapacityIndex:
+    """Unvisited locations ordered by volume, so the ones fitting into the remaining capacity form a prefix.
+
+    Removed locations are only marked dead and skipped by fitting, the arrays are compacted
+    once half of the entries are dead, so a removal costs amortized O(1) instead of a list memmove.
+    """
+
+    def __init__(self, loc_volumes: list, locations):
+        self.loc_volumes = loc_volumes
+        self.compact(sorted(locations, key=lambda loc: (loc_volumes[loc], loc)))
+
+    def compact(self, locs: list):
+        self.locs = locs
+        self.volumes = [self.loc_volumes[loc] for loc in locs]
+        self.positions = {loc: i for i, loc in enumerate(locs)}
+        self.alive = [True] * len(locs)
+        self.dead = 0
+
+    def remove(self, loc):
+        self.alive[self.positions.pop(loc)] = False
+        self.dead += 1
+        if 2 * self.dead > len(self.locs):
+            self.compact(list(compress(self.locs, self.alive)))
+
+    def fitting(self, capacity_left) -> list:
+        end = bisect_right(self.volumes, capacity_left)
+        if self.dead == 0:
+            return self.locs[:end]
+        return list(compress(self.locs[:end], self.alive))
 
 
 class VRPSolverInterface(ABC):
+    # Velocities of the time dependent travel model used when no travel time profile is given, km/h
+    base_velocity = 30
+    min_velocity = 11
 
     def __init__(
             self,
@@ -15,12 +56,23 @@ class VRPSolverInterface(ABC):
             starts: list[list[int]] = None,
             ends: list[list[int]] = None,
             distance_evaluator=None,
-            logger: LoggerInterface = None
+            logger: LoggerInterface = None,
+            num_neighbors: int | None = 20,
+            neighbors=None,
+            loc_volumes: list | None = None,
+            service_times: list | None = None,
+            travel_time_profile: TravelTimeProfile | None = None
     ):
         self.locations = locations
-        self.unvisited = set(range(1, len(self.locations)))
         self.demands = demands
         self.volumes = volumes
+        # Total volume of products for each location, computed once unless the problem is compiled already
+        if loc_volumes is None:
+            loc_volumes = [float(demands[loc] * volumes[loc]) for loc in range(len(locations))]
+        self.loc_volumes = loc_volumes
+        # Product handling time for each location, hours
+        self.service_times = service_times
+        self.reset_unvisited()
         self.time_windows = time_windows
         self.vehicle_capacities = vehicle_capacities
         self.vehicle_time_windows = vehicle_time_windows
@@ -28,44 +80,109 @@ class VRPSolverInterface(ABC):
         self.starts = starts if starts is not None else [[0]] * self.vehicle_count
         self.ends = ends if ends is not None else [[0]] * self.vehicle_count
         self.distance_evaluator = distance_evaluator
+        # Dense matrix is indexed directly by the solvers, a plain callable is only called when there is no matrix
+        self.distance_matrix = distance_evaluator if isinstance(distance_evaluator, DistanceMatrix) else None
         self.lg = logger
+        # Candidate lists of the closest locations, consulted first by the construction heuristics
+        self.num_neighbors = num_neighbors
+        self.neighbors = neighbors
+        # Speeds per hour bucket, measured ones if the profile is built from the segment statistics
+        if travel_time_profile is None:
+            travel_time_profile = TravelTimeProfile.from_velocities(self.base_velocity, self.min_velocity)
+        self.travel_time_profile = travel_time_profile
+
+    @classmethod
+    def from_compiled(cls, problem: CompiledProblem, **kwargs):
+        """Creates the solver for a compiled problem, nothing is derived from the entities again"""
+        kwargs.setdefault("travel_time_profile", problem.travel_time_profile())
+        return cls(
+            problem.locations,
+            problem.demands,
+            problem.volumes,
+            # Scalar reads from lists are much faster than from arrays in the solvers' inner loops
+            problem.time_windows.tolist(),
+            problem.vehicle_capacities.tolist(),
+            problem.vehicle_time_windows.tolist(),
+            distance_evaluator=problem.distance_matrix(),
+            loc_volumes=problem.volumes.tolist(),
+            service_times=problem.service_times.tolist(),
+            **kwargs
+        )
+
+    def get_distance_matrix(self) -> DistanceMatrix:
+        """Returns the dense distance matrix, evaluating it once if only a callable evaluator was provided"""
+        if self.distance_matrix is None:
+            self.distance_matrix = DistanceMatrix.from_evaluator(self.distance_evaluator, len(self.locations))
+        return self.distance_matrix
+
+    def get_neighbors(self):
+        """Returns k-nearest neighbor lists of the locations, or None if they are switched off"""
+        if self.neighbors is None and self.num_neighbors:
+            self.neighbors = self.get_distance_matrix().nearest_neighbors(self.num_neighbors)
+        return self.neighbors
+
+    def reset_unvisited(self):
+        """Marks all the locations except the depot as unvisited"""
+        self.unvisited = set(range(1, len(self.locations)))
+        self.capacity_index = CapacityIndex(self.loc_volumes, self.unvisited)
+
+    def visit(self, loc):
+        self.unvisited.remove(loc)
+        self.capacity_index.remove(loc)
 
     def select_feasible_locations(self, vehicle_loads, v):
-        feasible_locations = [
-            loc for loc in self.unvisited
-            if vehicle_loads[v] + self.demands[loc] * self.volumes[loc] <= self.vehicle_capacities[v]
-        ]
-        return feasible_locations
+        # Only the prefix of unvisited locations sorted by volume fits into the remaining capacity
+        return self.capacity_index.fitting(self.vehicle_capacities[v] - vehicle_loads[v])
 
     def travel_cost(self, from_node, to_node, current_time=None):
         # Get base distance in meters from evaluator and convert to km
+        if self.distance_matrix is not None:
+            return float(self.distance_matrix.distances[from_node, to_node]) / 1000
         cost = float(self.distance_evaluator(from_node, to_node) / 1000)
         return cost
 
-    def time_dependent_travel_time(self, from_node, to_node, current_time):
-        base_distance = self.travel_cost(from_node, to_node)
-        base_velocity = 30  # km/h
-        min_velocity = 11
-
-        if 0 <= current_time < 8:
-            velocity = base_velocity
-        elif 8 <= current_time < 23:
-            velocity = min_velocity
-        else:
-            velocity = base_velocity
-
-        travel_time = base_distance / velocity
+    def service_time(self, to_node, base_distance):
+        static_time = 5 / 60 if base_distance > 0 else 0  # 5 minutes
+        if self.service_times is not None:
+            return static_time + self.service_times[to_node]
 
         loc_quantity = self.demands[to_node]
-
-        static_time = 5 / 60 if base_distance > 0 else 0  # 5 minutes
         dynamic_time = loc_quantity * 30 / 3600  # 30 seconds per product
 
-        return travel_time + static_time + dynamic_time
+        return static_time + dynamic_time
 
-    def try_add_to_route(self, route, location, current_time, vehicle_load, vehicle_capacity, vehicle_shift_end=None):
+    def time_dependent_travel_time(self, from_node, to_node, current_time):
+        base_distance = self.travel_cost(from_node, to_node)
+        travel_time = self.travel_time_profile.travel_time(from_node, to_node, base_distance, current_time)
+        return travel_time + self.service_time(to_node, base_distance)
+
+    def max_travel_time(self, from_node, to_node):
+        """Travel time at the slowest speed of the day, an upper bound of time_dependent_travel_time"""
+        base_distance = self.travel_cost(from_node, to_node)
+        travel_time = self.travel_time_profile.max_travel_time(from_node, to_node, base_distance)
+        return travel_time + self.service_time(to_node, base_distance)
+
+    def build_route(self, locs, v):
+        """Times the given sequence of locations for the vehicle, returns None if the sequence is infeasible"""
+        route = RouteStops.from_depot(locs[0], capacity=len(locs))
+        current_time = 0.0
+        vehicle_load = 0.0
+        for loc in locs[1:]:
+            current_time, vehicle_load, wait_time, success = self.try_add_to_route(
+                route, loc, current_time, vehicle_load, self.vehicle_capacities[v]
+            )
+            if not success:
+                return None
+            route.append(loc, current_time, wait_time, vehicle_load)
+        return route
+
+    def try_add_to_route(
+            self, route: RouteStops, location, current_time, vehicle_load, vehicle_capacity, vehicle_shift_end=None
+    ):
+        """Checks whether the location can be appended to the route, returns the new time, load, wait time and success.
+        Routes in per-stop dicts are converted with RouteStops.from_dicts by the caller"""
         # Calc arrival time
-        arrival_time = current_time + self.time_dependent_travel_time(route[-1]["loc"], location, current_time)
+        arrival_time = current_time + self.time_dependent_travel_time(route.last_loc, location, current_time)
 
         # If it's too late for the location, reject the location
         if arrival_time > self.time_windows[location][1]:
@@ -86,8 +203,8 @@ class VRPSolverInterface(ABC):
             self.lg.print(f"\tToo late for location {location}, Current time {current_time}, Vehicle shift ends at {vehicle_shift_end}")
             return current_time, vehicle_load, wait_time, False
 
-        # Calc total volume of products for the location
-        loc_volume = self.demands[location] * self.volumes[location]
+        # Total volume of products for the location
+        loc_volume = self.loc_volumes[location]
 
         # If not enough capacity to load all products for the location, reject the location
         if vehicle_load + loc_volume > vehicle_capacity:
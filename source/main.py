@@ -1,3 +1,5 @@
+from multiprocessing import freeze_support
+
 from application import create_application
 
 
@@ -7,4 +9,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # Solvers may start worker processes, which needs this in the frozen (PyInstaller) build
+    freeze_support()
     main()
@@ -1,6 +1,37 @@
 import numpy as np
 import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 from source.domain.vrp_solver_interface import VRPSolverInterface
+from source.domain.entities.distance_matrix import DistanceMatrix
+from source.domain.entities.solution import RouteStops, Solution
+
+
+# Arrays of the solver which are shared with the worker processes instead of being copied to each of them
+SHARED_ARRAYS = ("pheromone", "heuristic", "distances")
+
+# Solver copy of a worker process, set once by the pool initializer
+_worker_solver = None
+_worker_memory = []
+
+
+def _init_ant_worker(solver, shared_arrays):
+    global _worker_solver
+    for name, (memory_name, shape, dtype) in shared_arrays.items():
+        memory = shared_memory.SharedMemory(name=memory_name)
+        _worker_memory.append(memory)
+        array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        if name == "distances":
+            solver.distance_matrix = DistanceMatrix(distances=array)
+            solver.distance_evaluator = solver.distance_matrix
+        else:
+            setattr(solver, name, array)
+    _worker_solver = solver
+
+
+def _construct_ant_in_worker(seed):
+    return _worker_solver.construct_ant_solution(np.random.default_rng(seed))
 
 
 # --- Основные параметры ---
@@ -22,10 +53,20 @@ class AntColonySolver(VRPSolverInterface):
             alpha=1.0,
             beta=2.0,
             evaporation_rate=0.1,
-            Q=100
+            Q=100,
+            vectorized=True,
+            seed=None,
+            num_workers=1,
+            num_neighbors=20,
+            neighbors=None,
+            loc_volumes=None,
+            service_times=None,
+            travel_time_profile=None
     ):
         super().__init__(locations, demands, volumes, time_windows, vehicle_capacities, vehicle_time_windows, starts,
-                         ends, distance_evaluator, logger)
+                         ends, distance_evaluator, logger, num_neighbors=num_neighbors, neighbors=neighbors,
+                         loc_volumes=loc_volumes, service_times=service_times,
+                         travel_time_profile=travel_time_profile)
         self.num_ants = num_ants
         self.num_iterations = num_iterations
         self.alpha = alpha  # Влияние феромона
@@ -36,11 +77,24 @@ class AntColonySolver(VRPSolverInterface):
         self.pheromone = np.ones((self.num_nodes, self.num_nodes))  # Матрица феромонов
         self.best_cost = float('inf')
         self.best_solution = None
+        self.vectorized = vectorized  # Построение решений на массивах NumPy
+        # Every ant gets its own seed derived from (iteration, ant), so the result doesn't depend on the workers
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.num_workers = num_workers  # Процессы для параллельного построения решений муравьями
+        self._shared_memory = []
+        self.heuristic = None  # Матрица эвристики (1/d)^beta, считается один раз перед решением
+        self.loc_volumes_array = np.asarray(self.loc_volumes, dtype=np.float64)
 
     def initial_solution(self):
         return [[0] for _ in range(self.num_ants)]
 
     def calculate_probabilities(self, current_node, unvisited):
+        if self.distance_matrix is not None:
+            # Whole row of candidates is taken from the matrix at once
+            distances = self.distance_matrix.distances[current_node, unvisited] / 1000
+            attractiveness = self.pheromone[current_node, unvisited] ** self.alpha * (1.0 / distances) ** self.beta
+            return attractiveness / attractiveness.sum()
+
         total_pheromone = 0
         probabilities = []
 
@@ -54,23 +108,82 @@ class AntColonySolver(VRPSolverInterface):
         probabilities = [p / total_pheromone for p in probabilities]
         return probabilities
 
+    def calculate_heuristic(self):
+        """Precomputes (1/d)^beta for all the node pairs, the construction then only multiplies it with pheromone rows"""
+        distances = self.get_distance_matrix().distances.astype(np.float64) / 1000
+        # Coincident locations are the most attractive ones, unreachable ones are never chosen
+        heuristic = (1.0 / np.maximum(distances, 1e-3)) ** self.beta
+        heuristic[~np.isfinite(distances)] = 0.
+        return heuristic
+
+    def construct_ant_solution(self, rng):
+        """Builds one ant's solution, filling the vehicles one by one with masked vector operations"""
+        solution = Solution([])
+        unvisited = np.ones(self.num_nodes, dtype=bool)
+        unvisited[0] = False
+
+        for v in range(self.vehicle_count):
+            route = RouteStops.from_depot()
+            current_time = 0.0
+            vehicle_load = 0.0
+            vehicle_capacity = self.vehicle_capacities[v]
+            # Nodes that were too late for the route stay rejected, the time only grows along it
+            rejected = np.zeros(self.num_nodes, dtype=bool)
+
+            while True:
+                current_node = route.last_loc
+                candidates = None
+                # Candidate list of the closest nodes is consulted first, all the nodes only if none of them fits
+                if self.neighbors is not None:
+                    closest = self.neighbors[current_node]
+                    candidates = closest[
+                        unvisited[closest] & ~rejected[closest]
+                        & (vehicle_load + self.loc_volumes_array[closest] <= vehicle_capacity)
+                    ]
+                if candidates is None or not candidates.size:
+                    candidates = np.flatnonzero(
+                        unvisited & ~rejected & (vehicle_load + self.loc_volumes_array <= vehicle_capacity)
+                    )
+                if not candidates.size:
+                    break
+
+                weights = self.pheromone[current_node, candidates] ** self.alpha * self.heuristic[current_node, candidates]
+                cumulative = np.cumsum(weights)
+                # Single draw per step against the cumulative sum of the weights
+                if cumulative[-1] > 0:
+                    pick = np.searchsorted(cumulative, rng.random() * cumulative[-1], side="right")
+                    next_node = int(candidates[min(pick, candidates.size - 1)])
+                else:
+                    next_node = int(candidates[rng.integers(candidates.size)])
+
+                new_time, new_load, wait_time, success = self.try_add_to_route(
+                    route, next_node, current_time, vehicle_load, vehicle_capacity
+                )
+                if not success:
+                    rejected[next_node] = True
+                    continue
+
+                route.append(next_node, new_time, wait_time, new_load)
+                current_time = new_time
+                vehicle_load = new_load
+                unvisited[next_node] = False
+
+            solution.routes.append(route)
+
+        return solution
+
     def construct_solution(self):
         solutions = []
         vehicle_loads = [0] * self.vehicle_count
         vehicle_times = [0] * self.vehicle_count
 
         for ant in range(self.num_ants):
-            route = [{
-                "loc": 0,
-                "arrival_time": 0.0,
-                "wait_time": 0.0,
-                "load": 0.0
-            }]
+            route = RouteStops.from_depot()
             # current_load = 0
-            self.unvisited = set(range(1, self.num_nodes))
+            self.reset_unvisited()
 
             while self.unvisited:
-                current_node = route[-1]['loc']
+                current_node = route.last_loc
                 feasible_nodes = self.select_feasible_locations(vehicle_loads, 0)
 
                 if not feasible_nodes:
@@ -86,17 +199,10 @@ class AntColonySolver(VRPSolverInterface):
                         route, next_node, current_time, vehicle_load, self.vehicle_capacities[0]
                     )
                     if success:
-                        route.append(
-                            {
-                                "loc": next_node,
-                                "arrival_time": new_time,
-                                "wait_time": wait_time,
-                                "load": new_load
-                            }
-                        )
+                        route.append(next_node, new_time, wait_time, new_load)
                         vehicle_times[0] = new_time
                         vehicle_loads[0] = new_load
-                        self.unvisited.remove(next_node)
+                        self.visit(next_node)
 
                     # route.append(next_node)
                     # current_load += self.demands[next_node]
@@ -104,14 +210,21 @@ class AntColonySolver(VRPSolverInterface):
             # route.append(0)  # Вернуться в депо
             solutions.append(route)
 
-        return solutions
+        return Solution(solutions)
 
     def calculate_cost(self, solution):
         total_cost = 0
 
+        if self.distance_matrix is not None:
+            for route in solution:
+                locs = route.stop_locs()
+                total_cost += float(self.distance_matrix.distances[locs[:-1], locs[1:]].sum())
+            return total_cost
+
         for route in solution:
-            for i in range(len(route) - 1):
-                total_cost += self.distance_evaluator(route[i]['loc'], route[i + 1]['loc'])
+            locs = route.stop_locs().tolist()
+            for i in range(len(locs) - 1):
+                total_cost += self.distance_evaluator(locs[i], locs[i + 1])
 
         return total_cost
 
@@ -119,19 +232,97 @@ class AntColonySolver(VRPSolverInterface):
         self.pheromone *= (1 - self.evaporation_rate)  # Испарение феромонов
 
         for solution, cost in zip(solutions, costs):
+            if cost <= 0:
+                continue
             for route in solution:
-                for i in range(len(route) - 1):
-                    self.pheromone[route[i]['loc'], route[i + 1]['loc']] += self.Q / cost
+                locs = route.stop_locs()
+                np.add.at(self.pheromone, (locs[:-1], locs[1:]), self.Q / cost)
+
+    def count_unserved(self, solution):
+        served = np.zeros(self.num_nodes, dtype=bool)
+        for route in solution:
+            served[route.stop_locs()] = True
+        return int(self.num_nodes - 1 - served[1:].sum())
+
+    def ant_seed(self, iteration, ant):
+        return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=(iteration, ant))
+
+    def __getstate__(self):
+        # Shared arrays are attached by the workers themselves, everything else is copied once per worker
+        state = self.__dict__.copy()
+        for name in ("pheromone", "heuristic", "distance_matrix", "distance_evaluator", "_shared_memory"):
+            state[name] = None
+        return state
+
+    def start_workers(self):
+        """Moves the read-only matrices to shared memory and starts the pool of ant constructing processes"""
+        shared_arrays = {}
+        for name in SHARED_ARRAYS:
+            array = self.distance_matrix.distances if name == "distances" else getattr(self, name)
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._shared_memory.append(memory)
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            shared[...] = array
+            shared_arrays[name] = (memory.name, array.shape, array.dtype)
+            # From now on the parent works with the shared copy, so pheromone updates are seen by the workers
+            if name == "distances":
+                self.distance_matrix.distances = shared
+            else:
+                setattr(self, name, shared)
+
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_ant_worker,
+            initargs=(self, shared_arrays)
+        )
+
+    def stop_workers(self, executor):
+        executor.shutdown()
+        # Arrays are copied back before the shared memory is released
+        self.pheromone = np.array(self.pheromone)
+        self.heuristic = np.array(self.heuristic)
+        self.distance_matrix.distances = np.array(self.distance_matrix.distances)
+        for memory in self._shared_memory:
+            memory.close()
+            memory.unlink()
+        self._shared_memory = []
 
     def solve(self):
+        executor = None
+        if self.vectorized:
+            self.get_distance_matrix()
+            self.get_neighbors()
+            self.heuristic = self.calculate_heuristic()
+            if self.num_workers > 1:
+                executor = self.start_workers()
+
+        try:
+            return self.run_iterations(executor)
+        finally:
+            if executor is not None:
+                self.stop_workers(executor)
+
+    def run_iterations(self, executor=None):
+        best_unserved = float('inf')
+
         for iteration in range(self.num_iterations):
-            solutions = [self.construct_solution() for _ in range(self.num_ants)]
+            seeds = [self.ant_seed(iteration, ant) for ant in range(self.num_ants)]
+            if executor is not None:
+                solutions = list(executor.map(_construct_ant_in_worker, seeds))
+            elif self.vectorized:
+                solutions = [self.construct_ant_solution(np.random.default_rng(seed)) for seed in seeds]
+            else:
+                solutions = [self.construct_solution() for _ in range(self.num_ants)]
             costs = [self.calculate_cost(solution) for solution in solutions]
+            unserved = [self.count_unserved(solution) for solution in solutions]
 
-            best_iteration_cost = min(costs)
-            best_iteration_solution = solutions[costs.index(best_iteration_cost)]
+            # Solutions serving more locations are preferred, then the shorter ones
+            best_index = min(range(len(solutions)), key=lambda s: (unserved[s], costs[s]))
+            best_iteration_cost = costs[best_index]
+            best_iteration_solution = solutions[best_index]
 
-            if best_iteration_cost < self.best_cost:
+            if (unserved[best_index], best_iteration_cost) < (best_unserved, self.best_cost):
+                best_unserved = unserved[best_index]
                 self.best_cost = best_iteration_cost
                 self.best_solution = best_iteration_solution
 
@@ -139,7 +330,8 @@ class AntColonySolver(VRPSolverInterface):
 
             self.lg.print(f"Iteration {iteration + 1}, Best Cost: {self.best_cost}")
 
-        return self.best_solution  # , self.best_cost
+        # Converted to the per-stop dicts only at the boundary
+        return self.best_solution.to_dicts()  # , self.best_cost
 
 
 if __name__ == '__main__':
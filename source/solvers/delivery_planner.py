@@ -1,23 +1,32 @@
-import numpy as np
+from datetime import datetime
 
+from source.adapters.loggers.logger import Logger
+from source.data_operator import DataOperator
 from source.domain.delivery_planner_interface import DeliveryPlannerInterface
 from source.domain.vrp_solver_interface import VRPSolverInterface
 from source.solvers.greedy_solver import GreedySolver
-from source.solvers.distance_evaluators import create_distance_evaluator_from_data, create_euclidian_distance_evaluator
+from source.solvers.local_search import LocalSearch
+from source.solvers.distance_evaluators import create_distance_evaluator_from_data, create_haversine_distance_matrix
 
 from source.domain.entities import *
 
 
 class DeliveryPlanner(DeliveryPlannerInterface):
 
-    def two_step_strategy(self, areas):
+    def __init__(self, data_operator: DataOperator | None = None):
+        # Compiles the problems inside the zones from the db, without it only the inter-zone routes are built
+        self.data_operator = data_operator
+
+    def two_step_strategy(self, areas, week_day: int | None = None):
+        """Builds the inter-zone routes of each area per vehicle category and the routes inside each zone.
+        Problems inside the zones get the distances and the travel time profiles measured on the week day
+        of planning (today's by default), returns the routes per depot"""
+        results = []
         # Consider all the areas separately
         for area in areas:
             depot_address = area["depot_address"]
-            orders = area["orders"]
-            order_products = area["order_products"]
+            orders: AreaOrders = area["orders"]
             delivery_zones = area["delivery_zones"]
-            addresses = area["addresses"]
             vehicles = area["vehicles"]
 
             # Build inter-zone problems
@@ -29,29 +38,18 @@ class DeliveryPlanner(DeliveryPlannerInterface):
             # Find the centroids of each zone
             # Sum all the volumes of each zone
             for dz in delivery_zones:
-                centroid = np.array([0, 0])
-                zone_volume = 0
-                zone_size = 0
-                for o, order in enumerate(orders):
-                    if order.delivery_zone_id != dz.id:
-                        continue
-                    centroid += np.array([addresses[o].latitude, addresses[o].longitude])
-                    for op in order_products[o]:
-                        zone_volume += op   # considering each op in this case is just volume value
-                    zone_size += 1
+                in_zone = orders.delivery_zone_ids == dz.id
+                if not in_zone.any():
+                    continue
+                centroid = orders.locations[in_zone].mean(axis=0)
+                zone_volume = orders.volumes[in_zone].sum()
 
                 if dz.type == "B":
-                    locations_b.append(
-                        [centroid[0] / zone_size,
-                         centroid[1] / zone_size]
-                    )
+                    locations_b.append(centroid.tolist())
                     volumes_b.append(zone_volume)
 
                 else:
-                    locations_c.append(
-                        [centroid[0] / zone_size,
-                         centroid[1] / zone_size]
-                    )
+                    locations_c.append(centroid.tolist())
                     volumes_c.append(zone_volume)
 
             def build_inter_zone_problem(locations, volumes, vehicle_capacities):
@@ -62,29 +60,45 @@ class DeliveryPlanner(DeliveryPlannerInterface):
                     time_windows=[(0, 24)] * len(locations),
                     vehicle_capacities=vehicle_capacities,
                     vehicle_time_windows=[(0, 24)] * len(vehicle_capacities),
-                    distance_evaluator=create_euclidian_distance_evaluator(locations)
+                    # Zone centroids are real coordinates, so the great circle distance in meters is used
+                    distance_evaluator=create_haversine_distance_matrix(locations)
                 )
                 return problem
 
-            problem_b = build_inter_zone_problem(
-                locations_b, volumes_b, [vehicle.volume_capacity for vehicle in vehicles if vehicle.type == "B"]
-            )
-            problem_c = build_inter_zone_problem(
-                locations_c, volumes_c, [vehicle.volume_capacity for vehicle in vehicles if vehicle.type == "C"]
-            )
-
-            routes_b = self.build_routes(problem_b, GreedySolver)
-            routes_c = self.build_routes(problem_c, GreedySolver)
+            def solve_inter_zone_problem(locations, volumes, category):
+                vehicle_capacities = [vehicle.volume_capacity for vehicle in vehicles if vehicle.category == category]
+                # Nothing to deliver or nobody to deliver it with
+                if len(locations) < 2 or not vehicle_capacities:
+                    return []
+                return self.build_routes(build_inter_zone_problem(locations, volumes, vehicle_capacities), GreedySolver)
+
+            # Solve problems inside each zone
+            zone_routes = {}
+            for dz in delivery_zones if self.data_operator is not None else []:
+                in_zone = orders.delivery_zone_ids == dz.id
+                category = "B" if dz.type == "B" else "C"
+                zone_vehicles = [vehicle for vehicle in vehicles if vehicle.category == category]
+                if not in_zone.any() or not zone_vehicles:
+                    continue
+                # Time windows are checked against the speeds measured on the zone's segments
+                problem = self.data_operator.compile_area(
+                    {**area, "orders": orders.select(in_zone), "vehicles": zone_vehicles}, week_day
+                )
+                zone_routes[dz.id] = self.build_routes(problem, GreedySolver)
 
             # Solve inter-zone problem
-            pass
-
-        # Solve problems inside each zone
+            results.append({
+                "depot_id": depot_address.id,
+                "routes_b": solve_inter_zone_problem(locations_b, volumes_b, "B"),
+                "routes_c": solve_inter_zone_problem(locations_c, volumes_c, "C"),
+                "zone_routes": zone_routes
+            })
 
         # Merge routes
 
         # Optimize resulting route
 
+        return results
         """locations.append((depot_address.latitude, depot_address.longitude))
         addresses.append(depot_address)
         time_windows.append((0, 24))
@@ -109,17 +123,20 @@ class DeliveryPlanner(DeliveryPlannerInterface):
     def export_routes(self):
         pass
 
-    def build_routes(self, problem: Problem, SolverClass):
-        solver = SolverClass(
-            problem.locations,
-            problem.demands,
-            problem.volumes,
-            problem.time_windows,
-            problem.vehicle_capacities,
-            problem.vehicle_time_windows,
-            problem.distance_evaluator
-        )
-        return solver.solve()
+    def build_routes(
+            self, problem: Problem | CompiledProblem, SolverClass, improve=True, snapshot_dir=None, logger=None
+    ):
+        if not isinstance(problem, CompiledProblem):
+            problem = CompiledProblem.from_problem(problem)
+        if snapshot_dir is not None:
+            # Real planning days are kept to rerun and benchmark the solvers on them, see algo_tester
+            problem.save_snapshot(snapshot_dir, meta={"solver": SolverClass.__name__, "created_at": datetime.now()})
+        # Solvers report rejected locations through the logger, so they always get one
+        solver = SolverClass.from_compiled(problem, logger=logger if logger is not None else Logger())
+        routes = solver.solve()
+        if improve:
+            routes = LocalSearch(solver).improve(routes)
+        return routes
 
     def edit_route(self):
         pass
@@ -1,27 +1,197 @@
+import hashlib
+
 import numpy as np
+from scipy.spatial import cKDTree
 
 from source.domain.database_interface import DatabaseInterface
+from source.domain.entities.distance_matrix import DistanceMatrix, _block_rows
+from source.domain.entities.travel_time_profile import TravelTimeProfile, HOURS_PER_DAY
+from source.domain.matrix_cache_interface import MatrixCacheInterface
+
+
+def matrix_cache_key(addresses_ids, statistics_version: int, aggregate: str) -> str:
+    """Key of the matrices of the address set, changed by any new statistics record"""
+    ids = np.unique(np.asarray(addresses_ids, dtype=np.int64))
+    digest = hashlib.sha256(ids.tobytes())
+    digest.update(f"{statistics_version}:{aggregate}".encode())
+    return digest.hexdigest()
+
+
+def create_distance_matrix_from_data(
+        addresses: list,
+        db: DatabaseInterface,
+        aggregate: str = 'latest',
+        cache: MatrixCacheInterface | None = None
+) -> DistanceMatrix:
+    """Builds the distance and duration matrices for the addresses with a bulk request to the db.
+    With a cache, the matrices of an address set already seen with the same statistics are loaded from it"""
+    # Several orders can share an address, so the db is queried for unique addresses only
+    # and the result is expanded back to the order of locations.
+    # Unique ids are sorted, so the same set of addresses always gives the same cached matrix
+    unique_ids, indices = np.unique(np.array([address.id for address in addresses], dtype=np.int64), return_inverse=True)
+    indices = indices.reshape(-1)
+
+    matrix = None
+    if cache is not None:
+        key = matrix_cache_key(unique_ids, db.get_segment_statistics_version(), aggregate)
+        matrix = cache.get(key)
+    # Entries stored without durations (e.g. by another user of the cache) can't be used here
+    if matrix is None or matrix.durations is None:
+        distances, durations = db.get_segments_statistics_matrices(unique_ids.tolist(), aggregate)
+        # Segments without statistics are considered unreachable
+        distances[np.isnan(distances)] = np.inf
+        durations[np.isnan(durations)] = np.inf
+        matrix = DistanceMatrix(distances=distances, durations=durations)
+        if cache is not None:
+            cache.put(key, matrix)
+
+    return DistanceMatrix(
+        distances=matrix.distances[np.ix_(indices, indices)],
+        durations=matrix.durations[np.ix_(indices, indices)]
+    )
 
 
 def create_distance_evaluator_from_data(addresses: list, db: DatabaseInterface):
-    def distance_evaluator(from_node, to_node):
-        nonlocal addresses
-        if addresses[from_node] == addresses[to_node]:
-            return 0.
-        distance = db.get_segment_statistics(db.get_segment(
-            addresses[from_node].id,
-            addresses[to_node].id
-        ).id)[0].distance
-        return distance
+    # The matrix is callable, so it can still be used as a plain distance evaluator
+    return create_distance_matrix_from_data(addresses, db)
 
-    return distance_evaluator
 
+# Measured speeds outside of this range (km/h) are considered broken records
+SPEED_LIMITS = (1., 150.)
 
-def create_euclidian_distance_evaluator(locations: list):
 
-    def distance_evaluator(from_index, to_index):
-        nonlocal locations
-        dist = np.linalg.norm(np.array(locations[from_index]) - np.array(locations[to_index]))
-        return dist
+def create_travel_time_profile_from_data(
+        addresses: list,
+        db: DatabaseInterface,
+        week_day: int,
+        buckets: int = 24,
+        default: TravelTimeProfile | None = None
+) -> TravelTimeProfile:
+    """Builds the speed profiles of the planning day from the segment statistics of the addresses.
+
+    Each segment measured on the week day gets its own row: the mean speed of its records in each hour bucket.
+    Buckets without records use the global profile scaled by how much faster or slower the segment is
+    than the global profile in its measured buckets. The global profile is the mean speed of all the records
+    of the week day per bucket, the default profile fills the buckets nobody measured.
+    """
+    if default is None:
+        default = TravelTimeProfile.from_velocities(30, 11)
+    # The default profile may have another bucket size, its speed at the middle of each bucket is used
+    middles = (np.arange(buckets) + 0.5) * HOURS_PER_DAY / buckets
+    default_speeds = default.speeds[0][(middles / default.bucket_hours).astype(int)].astype(np.float64)
+
+    unique_ids = list(dict.fromkeys(address.id for address in addresses))
+    records = db.get_segment_statistics_records(unique_ids)
+    # Durations of the routing sources are in seconds, distances in meters
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speeds = (records['distance'] / 1000) / (records['duration'] / 3600)
+    valid = (
+        (records['week_day'] == week_day) & np.isfinite(records['start_time'])
+        & (speeds >= SPEED_LIMITS[0]) & (speeds <= SPEED_LIMITS[1])
+    )
+    if not valid.any():
+        return TravelTimeProfile(speeds=default_speeds[None, :])
+
+    speeds = speeds[valid]
+    bucket = np.minimum((records['start_time'][valid] * buckets / HOURS_PER_DAY).astype(np.int64), buckets - 1)
+    # Segments are numbered by a single int64 key of the address pair, cheaper to sort than pairs of columns
+    address_1_ids, address_2_ids = records['address_1_id'][valid], records['address_2_id'][valid]
+    stride = int(max(address_1_ids.max(), address_2_ids.max())) + 1
+    keys, segment = np.unique(address_1_ids * stride + address_2_ids, return_inverse=True)
+    cells = segment.reshape(-1) * buckets + bucket
+
+    size = len(keys) * buckets
+    sums = np.bincount(cells, weights=speeds, minlength=size).astype(np.float32).reshape(len(keys), buckets)
+    counts = np.bincount(cells, minlength=size).astype(np.float32).reshape(len(keys), buckets)
+
+    total_counts = counts.sum(axis=0)
+    global_speeds = np.where(
+        total_counts > 0, sums.sum(axis=0, dtype=np.float64) / np.maximum(total_counts, 1), default_speeds
+    ).astype(np.float32)
+    # The segment speeds are computed in place of the sums, buckets without records get the scaled global speed
+    measured = counts > 0
+    segment_speeds = np.divide(sums, counts, out=sums, where=measured)
+    # Buckets without records hold zero here, so only the measured ones add up
+    ratios = (segment_speeds / global_speeds).sum(axis=1) / measured.sum(axis=1)
+    np.multiply(global_speeds[None, :], ratios[:, None], out=segment_speeds, where=~measured)
+    np.clip(segment_speeds, *SPEED_LIMITS, out=segment_speeds)
+
+    # Several locations (orders) can share an address, all their pairs use the row of the segment
+    node_ids = np.array([address.id for address in addresses], dtype=np.int64)
+    unique_ids, node_positions = np.unique(node_ids, return_inverse=True)
+    first = np.searchsorted(unique_ids, keys // stride)
+    second = np.searchsorted(unique_ids, keys % stride)
+    address_rows = np.zeros((len(unique_ids), len(unique_ids)), dtype=np.int32)
+    address_rows[first, second] = np.arange(1, len(keys) + 1, dtype=np.int32)
+    node_positions = node_positions.reshape(-1)
+
+    return TravelTimeProfile(
+        speeds=np.vstack([np.clip(global_speeds, *SPEED_LIMITS)[None, :], segment_speeds]),
+        node_rows=address_rows[np.ix_(node_positions, node_positions)]
+    )
 
-    return distance_evaluator
+
+EARTH_RADIUS = 6371 * 1000  # meters
+
+
+def calc_euclidian_distance_matrix(locations) -> np.ndarray:
+    """Calculates all the pairwise euclidian distances between the locations, block of rows at a time"""
+    points = np.asarray(locations, dtype=np.float64).reshape(len(locations), -1)
+    size = len(points)
+    distances = np.empty((size, size), dtype=np.float32)
+    step = _block_rows(size)
+    for start in range(0, size, step):
+        block = points[start:start + step]
+        squared = np.zeros((len(block), size), dtype=np.float64)
+        for axis in range(points.shape[1]):
+            squared += (block[:, axis, None] - points[None, :, axis]) ** 2
+        distances[start:start + step] = np.sqrt(squared)
+    return distances
+
+
+def calc_haversine_distance_matrix(locations) -> np.ndarray:
+    """Calculates all the pairwise great circle distances in meters between (latitude, longitude) locations"""
+    points = np.radians(np.asarray(locations, dtype=np.float64).reshape(len(locations), 2))
+    lat, lon = points[:, 0], points[:, 1]
+    cos_lat = np.cos(lat)
+    size = len(points)
+    distances = np.empty((size, size), dtype=np.float32)
+    step = _block_rows(size)
+    for start in range(0, size, step):
+        stop = start + step
+        dlat = lat[None, :] - lat[start:stop, None]
+        dlon = lon[None, :] - lon[start:stop, None]
+        a = np.sin(dlat / 2) ** 2 + cos_lat[start:stop, None] * cos_lat[None, :] * np.sin(dlon / 2) ** 2
+        distances[start:stop] = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0., 1.)))
+    return distances
+
+
+def calc_nearest_haversine(locations, candidates, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Indices of the k closest candidates and great circle distances to them in meters
+    for every (latitude, longitude) location, closest first.
+    Coordinates are put on the unit sphere, where the KD-tree chord distance orders the same as the great circle one.
+    A candidate at the same position as the location may be among the results, the caller filters the location itself"""
+    def to_sphere(points):
+        points = np.radians(np.asarray(points, dtype=np.float64).reshape(len(points), 2))
+        cos_lat = np.cos(points[:, 0])
+        return np.column_stack([cos_lat * np.cos(points[:, 1]), cos_lat * np.sin(points[:, 1]), np.sin(points[:, 0])])
+
+    k = max(0, min(k, len(candidates)))
+    if k == 0 or len(locations) == 0:
+        return np.empty((len(locations), 0), dtype=np.int64), np.empty((len(locations), 0), dtype=np.float64)
+    chords, closest = cKDTree(to_sphere(candidates)).query(to_sphere(locations), k=k)
+    chords, closest = chords.reshape(len(locations), k), closest.reshape(len(locations), k)
+    return closest, 2 * EARTH_RADIUS * np.arcsin(np.clip(chords / 2, 0., 1.))
+
+
+def create_euclidian_distance_matrix(locations: list) -> DistanceMatrix:
+    return DistanceMatrix(distances=calc_euclidian_distance_matrix(locations))
+
+
+def create_haversine_distance_matrix(locations: list) -> DistanceMatrix:
+    return DistanceMatrix(distances=calc_haversine_distance_matrix(locations))
+
+
+def create_euclidian_distance_evaluator(locations: list):
+    # All the distances are computed at once, the returned matrix is callable like the former closure
+    return create_euclidian_distance_matrix(locations)
@@ -1,31 +1,66 @@
 import random
-import math
-from itertools import combinations, permutations, product
+from collections import deque
+
+import numpy as np
+
+from source.domain.entities.distance_matrix import DistanceMatrix
+from source.solvers.distance_evaluators import calc_euclidian_distance_matrix
+
+EPSILON = 1e-9
+
 
 class KernighanLinSolver:
-    def __init__(self, locations, demands, vehicle_capacity, initial_route=None, distance_evaluator=None):
+    def __init__(
+            self,
+            locations,
+            demands,
+            vehicle_capacity,
+            initial_route=None,
+            distance_evaluator=None,
+            num_neighbors=10,
+            max_depth=6,
+            max_segment_length=3,
+            seed=None
+    ):
         self.locations = locations
         self.demands = demands
         self.vehicle_capacity = vehicle_capacity
         self.initial_route = initial_route
         self.distance_evaluator = distance_evaluator if distance_evaluator else self.default_distance_evaluator
         self.distance_matrix = self.calculate_distance_matrix()
+        self.num_neighbors = num_neighbors
+        self.max_depth = max_depth  # Maximal number of 2-opt moves in one sequential move
+        self.max_segment_length = max_segment_length
+        self.random = random.Random(seed)
+
+        self.rows = self.distance_matrix.tolist()
+        self.neighbors = DistanceMatrix(distances=self.distance_matrix).nearest_neighbors(num_neighbors).tolist()
+        # Reversing a path changes its cost only for asymmetric distances
+        self.symmetric = bool(np.array_equal(self.distance_matrix, self.distance_matrix.T))
+        self.tour = []
+        self.pos = []
+        self.reversed = False
+        self.asymmetry = 0.0
 
     def default_distance_evaluator(self, loc1, loc2):
         """
         Default distance evaluator using Euclidean distance.
         """
-        return math.sqrt((loc1[0] - loc2[0]) ** 2 + (loc1[1] - loc2[1]) ** 2)
+        return float(np.hypot(loc1[0] - loc2[0], loc1[1] - loc2[1]))
 
     def calculate_distance_matrix(self):
         """
         Calculate the distance matrix for all locations.
         """
+        if isinstance(self.distance_evaluator, DistanceMatrix):
+            return self.distance_evaluator.distances.astype(np.float64)
+        if self.distance_evaluator == self.default_distance_evaluator:
+            return calc_euclidian_distance_matrix(self.locations).astype(np.float64)
         size = len(self.locations)
-        distance_matrix = [[0] * size for _ in range(size)]
+        distance_matrix = np.zeros((size, size))
         for i in range(size):
             for j in range(size):
-                distance_matrix[i][j] = self.distance_evaluator(self.locations[i], self.locations[j])
+                distance_matrix[i, j] = self.distance_evaluator(self.locations[i], self.locations[j])
         return distance_matrix
 
     def calculate_distance(self, route):
@@ -34,130 +69,219 @@ class KernighanLinSolver:
         """
         total_distance = 0
         for i in range(len(route)):
-            total_distance += self.distance_matrix[route[i]][route[(i + 1) % len(route)]]
+            total_distance += self.rows[route[i]][route[(i + 1) % len(route)]]
         return total_distance
 
-    def k_opt(self, route, k):
+    # ***************************
+    # Tour state
+    # ***************************
+    def set_tour(self, tour):
         """
-        Perform a k-opt optimization on the given route.
+        Stores the tour with the positions of the nodes. The tour is changed in place by reversals,
+        the shorter side of a reversed path is the one moved, and the reversed flag tells
+        the direction the array is read in.
         """
-        best_route = route[:]
-        best_distance = self.calculate_distance(best_route)
-        improved = True
+        self.tour = list(tour)
+        self.pos = [0] * len(self.rows)
+        for k, node in enumerate(self.tour):
+            self.pos[node] = k
+        self.reversed = False
+        if not self.symmetric:
+            # Cost change of driving the whole tour in the opposite direction
+            self.asymmetry = self.path_asymmetry(self.tour[0], len(self.tour))
+
+    def route(self):
+        return self.tour[::-1] if self.reversed else self.tour[:]
+
+    def succ(self, node):
+        if self.reversed:
+            return self.tour[self.pos[node] - 1]
+        return self.tour[(self.pos[node] + 1) % len(self.tour)]
+
+    def pred(self, node):
+        if self.reversed:
+            return self.tour[(self.pos[node] + 1) % len(self.tour)]
+        return self.tour[self.pos[node] - 1]
+
+    def steps(self, a, b):
+        """Number of edges on the tour path from node a to node b"""
+        if self.reversed:
+            return (self.pos[a] - self.pos[b]) % len(self.tour)
+        return (self.pos[b] - self.pos[a]) % len(self.tour)
 
-        while improved:
-            improved = False
-            # Generate all combinations of k edges to consider for replacement
-            for edges_to_replace in combinations(range(len(route)), k):
-                # Generate all possible rearrangements of these edges
-                new_routes = self.generate_k_opt_variants(route, edges_to_replace)
+    def path_asymmetry(self, node, length):
+        """Cost change of reversing the tour path of length edges starting at the node"""
+        d = self.rows
+        total = 0.0
+        for _ in range(length):
+            after = self.succ(node)
+            total += d[after][node] - d[node][after]
+            node = after
+        return total
 
-                for new_route in new_routes:
-                    new_distance = self.calculate_distance(new_route)
-                    if new_distance < best_distance:
-                        best_route = new_route
-                        best_distance = new_distance
-                        improved = True
+    def reversal_asymmetry(self, t2, t3):
+        """Cost change of reversing the tour path from t2 to t3 for asymmetric distances, walking its shorter side"""
+        if self.symmetric:
+            return 0.0
+        d = self.rows
+        t1, t4 = self.pred(t2), self.succ(t3)
+        length = self.steps(t2, t3)
+        if 2 * length <= len(self.tour):
+            return self.path_asymmetry(t2, length)
+        # The whole tour minus the rest of it and the two edges around the path
+        return (
+            self.asymmetry - self.path_asymmetry(t4, self.steps(t4, t1))
+            - (d[t2][t1] - d[t1][t2]) - (d[t4][t3] - d[t3][t4])
+        )
 
-            route = best_route
+    def two_opt_delta(self, t1, t2, t3, t4):
+        """Cost change of replacing edges (t1, t2) and (t3, t4) with (t1, t3) and (t2, t4), where t2 = succ(t1)
+        and t4 = succ(t3), which reverses the path from t2 to t3"""
+        d = self.rows
+        return d[t1][t3] + d[t2][t4] - d[t1][t2] - d[t3][t4] + self.reversal_asymmetry(t2, t3)
 
-        return best_route, best_distance
+    def reverse(self, t2, t3):
+        """Reverses the tour path from t2 to t3 in place, moving the nodes of its shorter side only"""
+        if t2 == t3:
+            return
+        tour, pos, size = self.tour, self.pos, len(self.tour)
+        if not self.symmetric:
+            d = self.rows
+            t1, t4 = self.pred(t2), self.succ(t3)
+            self.asymmetry += (
+                d[t3][t1] - d[t1][t3] + d[t4][t2] - d[t2][t4] - (d[t2][t1] - d[t1][t2]) - (d[t4][t3] - d[t3][t4])
+                - 2 * self.reversal_asymmetry(t2, t3)
+            )
+        # Array positions of the path, read forward
+        i, j = (pos[t3], pos[t2]) if self.reversed else (pos[t2], pos[t3])
+        length = (j - i) % size + 1
+        if 2 * length > size:
+            # Reversing the rest of the tour and reading the array the other way gives the same tour
+            i, j = (j + 1) % size, (i - 1) % size
+            length = size - length
+            self.reversed = not self.reversed
+        for _ in range(length // 2):
+            a, b = tour[i], tour[j]
+            tour[i], tour[j] = b, a
+            pos[a], pos[b] = j, i
+            i = (i + 1) % size
+            j = (j - 1) % size
 
-    def generate_k_opt_variants(self, route, edges_to_replace):
+    # ***************************
+    # Moves
+    # ***************************
+    def lin_kernighan_move(self, t1):
         """
-        Generate all possible k-opt variants by rearranging the given edges.
+        Sequential move from t1: the edge (t1, t2) is broken, t2 is connected to a close node t4,
+        and the tour is closed by a 2-opt move. The search continues from the new closing edge
+        while the partial gain stays positive, the best tour along the way is kept.
         """
-        new_routes = []
-        n = len(route)
-
-        # Break the route into segments defined by edges_to_replace
-        segments = []
-        prev = 0
-        for edge in sorted(edges_to_replace):
-            segments.append(route[prev:edge + 1])
-            prev = edge + 1
-        segments.append(route[prev:] + route[:segments[0][0]])  # Complete the cycle
-
-        # Generate permutations of the segments
-        segment_permutations = permutations(segments)
-
-        for perm in segment_permutations:
-            # Reverse segments if needed and reconstruct the route
-            for reversed_segments in product([True, False], repeat=len(segments)):
-                new_route = []
-                for segment, reverse in zip(perm, reversed_segments):
-                    new_route.extend(segment[::-1] if reverse else segment)
-                # Ensure it forms a valid cycle
-                if len(set(new_route)) == n:
-                    new_routes.append(new_route[:n])
-
-        return new_routes
+        d = self.rows
+        total_delta = 0.0
+        best_delta = -EPSILON
+        best_depth = 0
+        partial_gain = 0.0
+        added = set()
+        steps = []
+
+        for depth in range(self.max_depth):
+            t2 = self.succ(t1)
+            best_step = None
+            for t4 in self.neighbors[t2]:
+                t3 = self.pred(t4)
+                if t4 in (t1, t2) or t3 == t2 or (t3, t4) in added:
+                    continue
+                # Gain criterion: the removed edge must be longer than the added one in total
+                gain = partial_gain + d[t1][t2] - d[t2][t4]
+                if gain <= 0:
+                    continue
+                delta = self.two_opt_delta(t1, t2, t3, t4)
+                if best_step is None or delta < best_step[0]:
+                    best_step = (delta, gain, t3, t4)
+            if best_step is None:
+                break
+
+            delta, partial_gain, t3, t4 = best_step
+            self.reverse(t2, t3)
+            steps.append((t2, t3, t4))
+            added.update(((t1, t3), (t2, t4)))
+            total_delta += delta
+            if total_delta < best_delta:
+                best_delta = total_delta
+                best_depth = len(steps)
+
+        # The steps after the best tour are undone, the path from t2 to t3 runs from t3 to t2 after a step
+        for t2, t3, _ in reversed(steps[best_depth:]):
+            self.reverse(t3, t2)
+        if best_depth == 0:
+            return None
+        changed = {t1}
+        for step in steps[:best_depth]:
+            changed.update(step)
+        return changed
+
+    def or_opt_move(self, node):
+        """Moves the segment of 1 to max_segment_length nodes starting at the node between two close nodes"""
+        d = self.rows
+        size = len(self.tour)
+        for length in range(1, min(self.max_segment_length, size - 2) + 1):
+            segment = [node]
+            for _ in range(length - 1):
+                segment.append(self.succ(segment[-1]))
+            first, last = segment[0], segment[-1]
+            p, n = self.pred(first), self.succ(last)
+            removal = d[p][n] - d[p][first] - d[last][n]
+            for v in self.neighbors[first]:
+                w = self.succ(v)
+                if v in segment or v == p:
+                    continue
+                delta = removal + d[v][first] + d[last][w] - d[v][w]
+                if delta < -EPSILON:
+                    # p first..last n..v w becomes p n..v first..last w by three reversals
+                    self.reverse(first, v)
+                    self.reverse(v, n)
+                    self.reverse(last, first)
+                    return {p, n, v, w, first, last}
+        return None
 
     def solve(self):
         """
-        Solve the TSP using an adaptation of the Kernighan-Lin algorithm with dynamic k-opt optimization.
+        Solve the TSP with Lin-Kernighan style sequential moves and Or-opt moves,
+        using neighbor lists and don't-look bits.
         """
         num_nodes = len(self.distance_matrix)
         # Use the initial route if provided, otherwise generate a random one
-        route = self.initial_route[0] if self.initial_route else list(range(num_nodes))
+        route = list(self.initial_route[0]) if self.initial_route else list(range(num_nodes))
         if not self.initial_route:
-            random.shuffle(route)
-
-        best_route = route[:]
-        best_distance = self.calculate_distance(route)
-
-        k = 2  # Start with 2-opt
-
-        for iteration in range(100):  # Limit the number of iterations
-            # Split the route into two groups
-            split_point = random.randint(1, num_nodes - 1)
-            group_a = route[:split_point]
-            group_b = route[split_point:]
-
-            # Perform swaps between the groups to minimize the total distance
-            for _ in range(10):  # Limit the number of swaps
-                best_swap = None
-                best_improvement = 0
-
-                for i in range(len(group_a)):
-                    for j in range(len(group_b)):
-                        new_group_a = group_a[:i] + [group_b[j]] + group_a[i + 1:]
-                        new_group_b = group_b[:j] + [group_a[i]] + group_b[j + 1:]
-
-                        new_route = new_group_a + new_group_b
-                        new_distance = self.calculate_distance(new_route)
-                        improvement = best_distance - new_distance
-
-                        if improvement > best_improvement:
-                            best_swap = (i, j)
-                            best_improvement = improvement
-
-                if best_swap is None:
-                    break
-
-                # Apply the best swap
-                i, j = best_swap
-                group_a[i], group_b[j] = group_b[j], group_a[i]
-
-            # Recombine the groups and apply k-opt optimization
-            route = group_a + group_b
-            route, distance = self.k_opt(route, k)
-
-            if distance < best_distance:
-                best_route = route[:]
-                best_distance = distance
-                k = min(k + 1, num_nodes - 1)  # Dynamically increase k
-            else:
-                k = max(2, k - 1)  # Dynamically decrease k
-
-        return best_route, best_distance
-
-# Example usage
-locations = [(0, 0), (1, 1), (2, 2), (3, 3)]
-demands = [0, 0, 0, 0]
-vehicle_capacity = 10
-solver = KernighanLinSolver(locations, demands, vehicle_capacity)
-
-best_route, best_distance = solver.solve()
-print("Best route:", best_route)
-print("Best distance:", best_distance)
+            self.random.shuffle(route)
+        if len(route) < 4:
+            return route, self.calculate_distance(route)
+
+        self.set_tour(route)
+        # Nodes with the don't-look bit off
+        queue = deque(route)
+        queued = set(route)
+        while queue:
+            node = queue.popleft()
+            queued.discard(node)
+            changed = self.lin_kernighan_move(node) or self.or_opt_move(node)
+            if changed:
+                for n in changed | {node}:
+                    if n not in queued:
+                        queue.append(n)
+                        queued.add(n)
+
+        best_route = self.route()
+        return best_route, self.calculate_distance(best_route)
+
+
+if __name__ == '__main__':
+    # Example usage
+    locations = [(0, 0), (1, 1), (2, 2), (3, 3)]
+    demands = [0, 0, 0, 0]
+    vehicle_capacity = 10
+    solver = KernighanLinSolver(locations, demands, vehicle_capacity)
+
+    best_route, best_distance = solver.solve()
+    print("Best route:", best_route)
+    print("Best distance:", best_distance)
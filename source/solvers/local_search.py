@@ -0,0 +1,312 @@
+from collections import deque
+
+from source.domain.vrp_solver_interface import VRPSolverInterface
+from source.domain.entities.solution import Solution
+
+# Matrices up to this size are converted to nested lists, reading python floats from them is the fastest
+LIST_MATRIX_SIZE = 3000
+EPSILON = 1e-6
+
+
+class LocalSearch:
+    """Improves the routes built by any solver with 2-opt, Or-opt, relocate, swap and cross-exchange moves.
+
+    Every move is priced with an O(1) cost delta on the distance matrix. Time windows are checked against
+    the earliest service times (forward) and the latest feasible arrivals (backward) of each route, using
+    the slowest travel time of the day, so an accepted move stays feasible with the solver's own timing.
+    Routes are open paths starting from the depot, as the solvers build them.
+    """
+
+    def __init__(
+            self,
+            solver: VRPSolverInterface,
+            max_evaluations=200_000,
+            max_segment_length=3,
+            operators=("two_opt", "or_opt", "relocate", "swap", "cross_exchange")
+    ):
+        self.solver = solver
+        self.max_evaluations = max_evaluations
+        self.max_segment_length = max_segment_length
+        self.operators = set(operators)
+        self.evaluations = 0
+
+        distances = solver.get_distance_matrix().distances
+        if len(distances) <= LIST_MATRIX_SIZE:
+            rows = distances.tolist()
+            self.d = lambda a, b: rows[a][b]
+        else:
+            self.d = lambda a, b: distances.item(a, b)
+        self.neighbors = solver.get_neighbors()
+        self.loc_volumes = solver.loc_volumes
+        self.capacities = solver.vehicle_capacities
+        self.tw_start = [float(tw[0]) for tw in solver.time_windows]
+        self.tw_end = [float(tw[1]) for tw in solver.time_windows]
+        self.tt = solver.max_travel_time
+
+        # Per route state, rebuilt only for the routes changed by a move
+        self.seqs = []
+        self.forward = []  # Prefix sums of the edge costs along the route
+        self.backward = []  # Prefix sums of the edge costs against the route, for reversed segments
+        self.starts = []  # Earliest service time at each position
+        self.latest = []  # Latest arrival at each position keeping the rest of the route feasible
+        self.loads = []
+        self.feasible = []
+        self.pos = {}
+
+    # ***************************
+    # Route state
+    # ***************************
+    def load_routes(self, seqs):
+        self.seqs = [list(seq) for seq in seqs]
+        count = len(self.seqs)
+        self.forward = [None] * count
+        self.backward = [None] * count
+        self.starts = [None] * count
+        self.latest = [None] * count
+        self.loads = [0.0] * count
+        self.feasible = [False] * count
+        self.pos = {}
+        for r in range(count):
+            self.update_route(r)
+
+    def update_route(self, r):
+        d, tt = self.d, self.tt
+        seq = self.seqs[r]
+
+        forward = [0.0]
+        backward = [0.0]
+        for a, b in zip(seq, seq[1:]):
+            forward.append(forward[-1] + d(a, b))
+            backward.append(backward[-1] + d(b, a))
+
+        starts = [0.0]
+        feasible = True
+        for k in range(1, len(seq)):
+            arrival = starts[-1] + tt(seq[k - 1], seq[k])
+            if arrival > self.tw_end[seq[k]]:
+                feasible = False
+            starts.append(max(arrival, self.tw_start[seq[k]]))
+
+        latest = [float('inf')] * len(seq)
+        if len(seq) > 1:
+            latest[-1] = self.tw_end[seq[-1]]
+        for k in range(len(seq) - 2, -1, -1):
+            limit = latest[k + 1] - tt(seq[k], seq[k + 1])
+            latest[k] = min(self.tw_end[seq[k]], limit) if self.tw_start[seq[k]] <= limit else float('-inf')
+
+        self.forward[r] = forward
+        self.backward[r] = backward
+        self.starts[r] = starts
+        self.latest[r] = latest
+        self.loads[r] = sum(self.loc_volumes[loc] for loc in seq)
+        # Routes infeasible under the slowest travel times are left as the solver built them
+        self.feasible[r] = feasible
+        for k in range(1, len(seq)):
+            self.pos[seq[k]] = (r, k)
+
+    def fits(self, r, p, middle, q):
+        """Whether the route r prefix up to position p, then the middle locations,
+        then the route r suffix from position q is feasible in time"""
+        seq = self.seqs[r]
+        current_time = self.starts[r][p]
+        prev = seq[p]
+        for loc in middle:
+            arrival = current_time + self.tt(prev, loc)
+            if arrival > self.tw_end[loc]:
+                return False
+            current_time = max(arrival, self.tw_start[loc])
+            prev = loc
+        if q < len(seq):
+            return current_time + self.tt(prev, seq[q]) <= self.latest[r][q]
+        return True
+
+    def edge(self, a, b):
+        # Routes are open, there is no edge after the last location
+        return 0.0 if b is None else self.d(a, b)
+
+    @staticmethod
+    def at(seq, k):
+        return seq[k] if k < len(seq) else None
+
+    # ***************************
+    # Moves
+    # ***************************
+    def try_relocate(self, r, i, length, r2, j):
+        """Moves the segment of the route r starting at i after the position j of the route r2"""
+        seq, seq2 = self.seqs[r], self.seqs[r2]
+        if i + length > len(seq) or (r == r2 and i - 1 <= j <= i + length - 1):
+            return None
+        self.evaluations += 1
+
+        segment = seq[i:i + length]
+        p, n = seq[i - 1], self.at(seq, i + length)
+        v, w = seq2[j], self.at(seq2, j + 1)
+        delta = (
+            self.edge(p, n) - self.d(p, segment[0]) - self.edge(segment[-1], n)
+            + self.d(v, segment[0]) + self.edge(segment[-1], w) - self.edge(v, w)
+        )
+        if delta >= -EPSILON:
+            return None
+
+        if r != r2:
+            volume = sum(self.loc_volumes[loc] for loc in segment)
+            if self.loads[r2] + volume > self.capacities[r2]:
+                return None
+            if not (self.fits(r, i - 1, [], i + length) and self.fits(r2, j, segment, j + 1)):
+                return None
+            return {r: seq[:i] + seq[i + length:], r2: seq2[:j + 1] + segment + seq2[j + 1:]}
+
+        if j < i:
+            middle = segment + seq[j + 1:i]
+            if not self.fits(r, j, middle, i + length):
+                return None
+            return {r: seq[:j + 1] + middle + seq[i + length:]}
+        middle = seq[i + length:j + 1] + segment
+        if not self.fits(r, i - 1, middle, j + 1):
+            return None
+        return {r: seq[:i] + middle + seq[j + 1:]}
+
+    def try_two_opt(self, r, i, j):
+        """Reverses the route r between positions i + 1 and j, connecting the location at i with the one at j"""
+        seq = self.seqs[r]
+        if j <= i + 1:
+            return None
+        self.evaluations += 1
+
+        forward, backward = self.forward[r], self.backward[r]
+        u, a, b, n = seq[i], seq[i + 1], seq[j], self.at(seq, j + 1)
+        delta = (
+            self.d(u, b) + (backward[j] - backward[i + 1]) + self.edge(a, n)
+            - self.d(u, a) - (forward[j] - forward[i + 1]) - self.edge(b, n)
+        )
+        if delta >= -EPSILON:
+            return None
+
+        middle = seq[i + 1:j + 1][::-1]
+        if not self.fits(r, i, middle, j + 1):
+            return None
+        return {r: seq[:i + 1] + middle + seq[j + 1:]}
+
+    def try_exchange(self, r, i, length, r2, j, length2):
+        """Exchanges the segment of the route r starting at i with the segment of the route r2 starting at j"""
+        seq, seq2 = self.seqs[r], self.seqs[r2]
+        if i + length > len(seq) or j + length2 > len(seq2):
+            return None
+        self.evaluations += 1
+
+        segment, segment2 = seq[i:i + length], seq2[j:j + length2]
+        p, n = seq[i - 1], self.at(seq, i + length)
+        p2, n2 = seq2[j - 1], self.at(seq2, j + length2)
+        delta = (
+            self.d(p, segment2[0]) + self.edge(segment2[-1], n) + self.d(p2, segment[0]) + self.edge(segment[-1], n2)
+            - self.d(p, segment[0]) - self.edge(segment[-1], n) - self.d(p2, segment2[0]) - self.edge(segment2[-1], n2)
+        )
+        if delta >= -EPSILON:
+            return None
+
+        volume = sum(self.loc_volumes[loc] for loc in segment)
+        volume2 = sum(self.loc_volumes[loc] for loc in segment2)
+        if self.loads[r] - volume + volume2 > self.capacities[r]:
+            return None
+        if self.loads[r2] - volume2 + volume > self.capacities[r2]:
+            return None
+        if not (self.fits(r, i - 1, segment2, i + length) and self.fits(r2, j - 1, segment, j + length2)):
+            return None
+        return {r: seq[:i] + segment2 + seq[i + length:], r2: seq2[:j] + segment + seq2[j + length2:]}
+
+    def improve_location(self, u):
+        """Looks for an improving move creating an edge from u to one of its nearest neighbors (or from them to u)
+        and applies the first one found. Returns the locations around the changed edges"""
+        r, i = self.pos[u]
+        if not self.feasible[r]:
+            return None
+
+        for v in self.neighbors[u].tolist():
+            # Insertion right after the depot is possible at the start of any route
+            targets = [(r2, 0) for r2 in range(len(self.seqs))] if v == 0 else [self.pos.get(v)]
+            for target in targets:
+                if target is None or not self.feasible[target[0]]:
+                    continue
+                r2, j = target
+                for length in range(1, self.max_segment_length + 1):
+                    operator = "or_opt" if r == r2 else "relocate"
+                    if operator in self.operators:
+                        move = self.try_relocate(r, i, length, r2, j)
+                        if move:
+                            return self.apply(move)
+
+                if r == r2 and "two_opt" in self.operators:
+                    move = self.try_two_opt(r, i, j)
+                    if move:
+                        return self.apply(move)
+
+                if r != r2 and j + 1 < len(self.seqs[r2]):
+                    for length in range(1, self.max_segment_length + 1):
+                        for length2 in range(1, self.max_segment_length + 1):
+                            operator = "swap" if length == length2 == 1 else "cross_exchange"
+                            if operator not in self.operators:
+                                continue
+                            # Segment of u goes right after v, the segment following v takes its place
+                            move = self.try_exchange(r, i, length, r2, j + 1, length2)
+                            if move:
+                                return self.apply(move)
+
+                if self.evaluations >= self.max_evaluations:
+                    return None
+        return None
+
+    def apply(self, move):
+        touched = set()
+        for r, seq in move.items():
+            old = self.seqs[r]
+            for loc in old[1:]:
+                self.pos.pop(loc, None)
+            self.seqs[r] = seq
+            # Locations whose neighbors in the route have changed get their don't-look bits reset
+            old_edges = set(zip(old, old[1:]))
+            for a, b in zip(seq, seq[1:]):
+                if (a, b) not in old_edges:
+                    touched.update((a, b))
+        for r in move:
+            self.update_route(r)
+        touched.discard(0)
+        return touched
+
+    # ***************************
+    # Entry point
+    # ***************************
+    def improve(self, routes):
+        """Improves the solution (Solution or the solver output in per-stop dicts), returns it in the same form"""
+        solution = routes if isinstance(routes, Solution) else Solution.from_dicts(routes)
+        if self.neighbors is None:
+            return routes
+
+        self.load_routes([route.stop_locs().tolist() for route in solution])
+        self.evaluations = 0
+
+        # Queue of locations with the don't-look bit off
+        queue = deque(self.pos)
+        queued = set(queue)
+        while queue and self.evaluations < self.max_evaluations:
+            u = queue.popleft()
+            queued.discard(u)
+            touched = self.improve_location(u)
+            if touched:
+                for loc in touched:
+                    if loc not in queued:
+                        queue.append(loc)
+                        queued.add(loc)
+
+        improved = self.build_solution(solution)
+        return improved if isinstance(routes, Solution) else improved.to_dicts()
+
+    def build_solution(self, solution):
+        """Times the improved routes with the solver's own model"""
+        routes = []
+        for v, seq in enumerate(self.seqs):
+            route = self.solver.build_route(seq, v)
+            if route is None:
+                # Can't happen with FIFO travel times, but the solver's result is always a safe answer
+                return solution
+            routes.append(route)
+        return Solution(routes)
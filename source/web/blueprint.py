@@ -1,7 +1,10 @@
-from flask import Blueprint, render_template, redirect, request, current_app
+import numpy as np
+from flask import Blueprint, render_template, redirect, request, current_app, jsonify, url_for
 from source.data_operator import DataOperator
 from source.domain.map_drawer_interface import MapDrawer
 from source.domain.entities import *
+from source.solvers.delivery_planner import DeliveryPlanner
+from source.web.job_runner import JobRunner
 
 # cfg = Config()
 
@@ -10,6 +13,39 @@ def create_app_blueprint():
     app = Blueprint('app', __name__)
     dataop: DataOperator = current_app.config["DATA_OPERATOR"]
     map_drawer: MapDrawer = current_app.config["MAP_DRAWER"]
+    job_runner: JobRunner = current_app.config["JOB_RUNNER"]
+
+    def job_accepted(job_id, redirect_url):
+        # API clients get the job id to poll its status, forms are redirected back as before
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({
+                "job_id": job_id,
+                "status_url": url_for('app.job_status', job_id=job_id)
+            }), 202
+        return redirect(redirect_url)
+
+    def load_data_job(job):
+        job.report_progress(0., "Загрузка данных из 1C")
+        return dataop.load_data_from_business_to_db()
+
+    def run_vrp_job(job, vehicles_ids, orders_ids):
+        job.report_progress(0., "Загрузка заказов")
+        areas = dataop.from_db()
+        for area in areas.values():
+            area["orders"] = area["orders"].select(np.isin(area["orders"].order_ids, list(orders_ids)))
+            area["vehicles"] = [vehicle for vehicle in area["vehicles"] if vehicle.id in vehicles_ids]
+        job.report_progress(0.2, "Построение маршрутов")
+        return DeliveryPlanner(dataop).two_step_strategy(list(areas.values()))
+
+    @app.before_request
+    def open_db_connection():
+        # Pages only read from the db, so GET requests get a connection which can't write.
+        # Each request thread takes its own connection from the pool on the first query
+        dataop.db.set_read_only(request.method == 'GET')
+
+    @app.teardown_request
+    def close_db_connection(exception):
+        dataop.db.release_connection()
 
     @app.route('/')
     @app.route('/index')
@@ -197,8 +233,9 @@ def create_app_blueprint():
         if request.method == 'POST':
             if 'url_business_api_input' in request.form.keys() and request.form['url_business_api_input'] != '':
                 current_app.config["URL_BUSINESS_API"] = request.form['url_business_api_input']
-            dataop.load_data_from_business_to_db()
+            job_id = job_runner.submit('load_data', load_data_job)
             # dataop.from_db()
+            return job_accepted(job_id, request.referrer)
         return redirect(request.referrer)
 
     @app.route('/run_vrp', methods=['POST'])
@@ -216,12 +253,25 @@ def create_app_blueprint():
                     if v == 'on':
                         orders_ids.append(order_id)
 
-            # vw.run(vehicles_ids, orders_ids)
+            # Solving takes long, it is done by the job runner and the request returns immediately
+            job_id = job_runner.submit('run_vrp', run_vrp_job, set(vehicles_ids), set(orders_ids))
             # vw.export_routes()
             # # Update selected but not delivered orders
             # vw.selected_but_not_delivered = orders_ids.copy()
             # # Remove delivered orders from selected_but_not_delivered
             # vw.selected_but_not_delivered = [order_id for order_id in vw.selected_but_not_delivered if order_id not in vw.delivered_orders]
+            return job_accepted(job_id, '/build_routes')
         return redirect('/build_routes')
 
+    @app.route('/jobs')
+    def jobs():
+        return jsonify([job.to_dict() for job in job_runner.list_jobs()])
+
+    @app.route('/jobs/<job_id>')
+    def job_status(job_id):
+        job = job_runner.get(job_id)
+        if job is None:
+            return jsonify({"error": "job not found"}), 404
+        return jsonify(job.to_dict())
+
     return app
@@ -0,0 +1,120 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from dataclasses import dataclass, field, asdict
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    status: str = "queued"  # queued, running, done, failed
+    progress: float = 0.0  # from 0 to 1
+    message: str = ""
+    result: object = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    def report_progress(self, progress: float, message: str = ""):
+        """Called by the job function from the worker thread"""
+        self.progress = min(max(progress, 0.), 1.)
+        if message:
+            self.message = message
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class JobRunner:
+    """Runs long tasks (solving, imports) in worker threads, so the web requests only enqueue them.
+
+    Job functions get the Job as the only argument and may report progress through it.
+    Finished jobs are kept in memory and saved as JSON to the results directory,
+    so their status and results are available after a restart.
+    """
+
+    def __init__(self, results_dir, num_workers=1, cleanup=None):
+        self.results_dir = results_dir
+        os.makedirs(results_dir, exist_ok=True)
+        # Called in the worker thread after each job, e.g. to return the db connection of the thread to the pool
+        self.cleanup = cleanup
+        self.jobs: dict[str, Job] = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.workers = [
+            threading.Thread(target=self.work, name=f"job-worker-{w}", daemon=True) for w in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, kind: str, func, *args, **kwargs) -> str:
+        """Enqueues the job and returns its id immediately"""
+        job = Job(id=uuid.uuid4().hex, kind=kind)
+        with self.lock:
+            self.jobs[job.id] = job
+        self.queue.put((job, func, args, kwargs))
+        return job.id
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        return self.load(job_id)
+
+    def list_jobs(self) -> list[Job]:
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            job, func, args, kwargs = task
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = func(job, *args, **kwargs)
+                job.progress = 1.
+                job.status = "done"
+            except Exception as e:
+                job.error = f"{e!r}\n{traceback.format_exc()}"
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                if self.cleanup:
+                    self.cleanup()
+                self.save(job)
+                self.queue.task_done()
+
+    def path(self, job_id: str) -> str:
+        return os.path.join(self.results_dir, f"{job_id}.json")
+
+    def save(self, job: Job):
+        # Results which are not JSON serializable (dates, entities) are saved as strings
+        with open(self.path(job.id), "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f, ensure_ascii=False, default=str)
+
+    def load(self, job_id: str) -> Job | None:
+        # Ids are generated hex strings, anything else can't be a saved job
+        if not all(c in "0123456789abcdef" for c in job_id) or not os.path.exists(self.path(job_id)):
+            return None
+        with open(self.path(job_id), encoding="utf-8") as f:
+            job = Job(**json.load(f))
+        with self.lock:
+            self.jobs.setdefault(job.id, job)
+        return job
+
+    def shutdown(self, wait=True):
+        for _ in self.workers:
+            self.queue.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()